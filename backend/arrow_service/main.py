@@ -6,18 +6,41 @@ Apache Arrow性能测试后端
 2. 用户-SKU互动日志数据
 """
 
-from fastapi import FastAPI, Query, Response, HTTPException
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Query, Response, HTTPException, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
-from datetime import date, datetime
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, Field
+from datetime import date, datetime, timedelta
+import numpy as np
 import pyarrow as pa
 import pyarrow.ipc as ipc
 import pyarrow.compute as pc
+import pyarrow.parquet as pq
 from pathlib import Path
+import asyncio
 import io
 import json
+import logging
+import os
+import time
+import uuid
 
-app = FastAPI(title="Arrow Performance Test API")
+from arrow_service import sketches, validation
+
+logger = logging.getLogger(__name__)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """启动时在后台线程预热数据，/ready 在预热完成后才返回 200"""
+    task = asyncio.create_task(asyncio.to_thread(warm_up))
+    yield
+    if not task.done():
+        task.cancel()
+
+
+app = FastAPI(title="Arrow Performance Test API", lifespan=lifespan)
 
 # 配置CORS
 app.add_middleware(
@@ -29,15 +52,49 @@ app.add_middleware(
 )
 
 # 数据文件路径
-DATA_DIR = Path(__file__).parent.parent / "data"
+DATA_DIR = Path(os.environ.get("ARROW_DATA_DIR", Path(__file__).parent.parent / "data"))
 AD_REPORT_PATH = DATA_DIR / "ads.arrow"
 USER_SKU_LOGS_PATH = DATA_DIR / "user_sku_logs.arrow"
 ADS_SHARDS_DIR = DATA_DIR / "ads_shards"
+USER_SKU_LOGS_PARTITIONS_DIR = DATA_DIR / "user_sku_logs"
+
+# 归因 join 两侧聚合结果的内存上限（字节），超出时拒绝请求
+ATTRIBUTION_MAX_JOIN_BYTES = int(os.environ.get("ARROW_ATTRIBUTION_MAX_JOIN_BYTES", 256 * 1024 * 1024))
+
+# 启动预热配置
+PRELOAD_ENABLED = os.environ.get("ARROW_PRELOAD", "1") == "1"
+# 预加载最近 N 个月的分片
+PRELOAD_SHARDS = int(os.environ.get("ARROW_PRELOAD_SHARDS", 3))
+# 是否顺序读取数据文件，提前把页面读入 page cache，避免首批请求触发缺页
+PRELOAD_PREFAULT = os.environ.get("ARROW_PRELOAD_PREFAULT", "0") == "1"
+
+# 实时推送：检查分片文件是否有新增 record batch 的间隔（秒）
+LIVE_POLL_INTERVAL = float(os.environ.get("ARROW_LIVE_POLL_INTERVAL", 1))
+
+# 导出准入控制：单个响应的预估大小上限、每个 worker 同时在途的预估字节数上限，
+# 预算不足时最多排队的请求数和排队超时（秒）
+MAX_RESPONSE_BYTES = int(os.environ.get("ARROW_MAX_RESPONSE_BYTES", 256 * 1024 * 1024))
+MAX_INFLIGHT_BYTES = int(os.environ.get("ARROW_MAX_INFLIGHT_BYTES", 512 * 1024 * 1024))
+EXPORT_QUEUE_SIZE = int(os.environ.get("ARROW_EXPORT_QUEUE_SIZE", 4))
+EXPORT_QUEUE_TIMEOUT = float(os.environ.get("ARROW_EXPORT_QUEUE_TIMEOUT", 10))
 
 # 缓存加载的数据
 _ad_report_table = None
 _user_sku_logs_table = None
 _shards_metadata = None
+_shards_metadata_mtime = None
+_logs_partitions_metadata = None
+_logs_partitions_metadata_mtime = None
+_logs_partition_tables = {}
+_file_version_cache = {}
+_shard_tables = {}
+_warmup_state = {
+    "ready": not PRELOAD_ENABLED,
+    "started_at": None,
+    "finished_at": None,
+    "steps": [],
+    "errors": [],
+}
 
 
 def load_ad_report():
@@ -50,26 +107,167 @@ def load_ad_report():
 
 
 def load_shards_metadata():
-    """加载分片元数据"""
-    global _shards_metadata
-    if _shards_metadata is None:
-        metadata_path = ADS_SHARDS_DIR / "metadata.json"
-        if metadata_path.exists():
-            with open(metadata_path) as f:
-                _shards_metadata = json.load(f)
+    """加载分片元数据（metadata.json 被更新后自动重新加载）"""
+    global _shards_metadata, _shards_metadata_mtime
+    metadata_path = ADS_SHARDS_DIR / "metadata.json"
+    if not metadata_path.exists():
+        return _shards_metadata
+
+    mtime = metadata_path.stat().st_mtime_ns
+    if _shards_metadata is None or mtime != _shards_metadata_mtime:
+        with open(metadata_path) as f:
+            _shards_metadata = json.load(f)
+        _shards_metadata_mtime = mtime
     return _shards_metadata
 
 
-def load_ad_report_shard(year_month: str):
-    """加载指定月份的广告数据分片"""
+def get_shard_version(year_month: str) -> int:
+    """
+    获取分片当前版本号
+
+    版本号即分片文件中的 record batch 数量，只读取 IPC 文件 footer，不加载数据。
+    当月分片以追加 record batch 的方式增长，版本号单调递增。
+    """
+    shard_path = ADS_SHARDS_DIR / f"ads_{year_month}.arrow"
+    if not shard_path.exists():
+        raise FileNotFoundError(f"Shard not found: {year_month}")
+
+    with pa.memory_map(str(shard_path), 'r') as source:
+        return ipc.open_file(source).num_record_batches
+
+
+def read_shard_batches(year_month: str, since: int = 0):
+    """
+    读取分片第 since 个之后追加的 record batch（只读取新增部分）
+
+    Returns:
+        tuple: (schema, 新增的 record batch 列表, 当前版本号)；since 大于当前版本时 batch 列表为空
+    """
     shard_path = ADS_SHARDS_DIR / f"ads_{year_month}.arrow"
     if not shard_path.exists():
         raise FileNotFoundError(f"Shard not found: {year_month}")
 
     with pa.memory_map(str(shard_path), 'r') as source:
+        reader = ipc.open_file(source)
+        version = reader.num_record_batches
+        batches = [reader.get_batch(i) for i in range(since, version)]
+        return reader.schema, batches, version
+
+
+def resolve_shard_path(year_month: str) -> Path | None:
+    """返回月份分片的文件路径：优先 IPC 分片，已归档的月份返回 Parquet 分片，都不存在时返回 None"""
+    shard_path = ADS_SHARDS_DIR / f"ads_{year_month}.arrow"
+    if shard_path.exists():
+        return shard_path
+    parquet_path = ADS_SHARDS_DIR / f"ads_{year_month}.parquet"
+    if parquet_path.exists():
+        return parquet_path
+    return None
+
+
+def read_shard_file(path: Path) -> pa.Table:
+    """读取 IPC（内存映射）或 Parquet 文件"""
+    if path.suffix == ".parquet":
+        return pq.read_table(path)
+    with pa.memory_map(str(path), 'r') as source:
         return ipc.open_file(source).read_all()
 
 
+def load_ad_report_shard(year_month: str):
+    """
+    加载指定月份的广告数据分片
+
+    IPC 分片内存映射后缓存；已归档的月份每次从 Parquet 解码，不常驻内存。
+    """
+    shard_path = resolve_shard_path(year_month)
+    if shard_path is None:
+        raise FileNotFoundError(f"Shard not found: {year_month}")
+    if shard_path.suffix == ".parquet":
+        _shard_tables.pop(year_month, None)
+        return pq.read_table(shard_path)
+    return load_ad_report_shard_versioned(year_month)[0]
+
+
+def load_ad_report_shard_versioned(year_month: str):
+    """
+    加载 IPC 分片，同时返回数据对应的分片版本号（record batch 数量）
+
+    版本号与表来自同一个 reader，并和表一起缓存；若另外打开文件读取版本号，
+    并发追加时版本号可能领先于已返回的数据。
+
+    Returns:
+        tuple: (表, 版本号)
+    """
+    shard_path = ADS_SHARDS_DIR / f"ads_{year_month}.arrow"
+    if not shard_path.exists():
+        raise FileNotFoundError(f"Shard not found: {year_month}")
+
+    # 按文件版本缓存（内存映射，零拷贝），分片被追加或重写后重新映射
+    stat = shard_path.stat()
+    file_version = (stat.st_mtime_ns, stat.st_size)
+    cached = _shard_tables.get(year_month)
+    if cached is None or cached[0] != file_version:
+        with pa.memory_map(str(shard_path), 'r') as source:
+            reader = ipc.open_file(source)
+            cached = (file_version, reader.read_all(), reader.num_record_batches)
+        _shard_tables[year_month] = cached
+    return cached[1], cached[2]
+
+
+def get_ad_shard_schema(year_months: list[str]) -> pa.Schema:
+    """从第一个存在的分片 footer 读取 schema（IPC 或 Parquet）"""
+    for year_month in year_months:
+        shard_path = resolve_shard_path(year_month)
+        if shard_path is not None:
+            return read_file_stats(shard_path)["schema"]
+    raise ValueError("No valid shards found")
+
+
+def parquet_row_group_matches(row_group, column_index: dict, start_date=None, end_date=None,
+                              advertiser_id=None, campaign_type=None) -> bool:
+    """根据 row group 的 min/max 统计判断是否可能包含满足过滤条件的行"""
+    bounds = [
+        ('date', start_date, end_date),
+        ('advertiser_id', advertiser_id, advertiser_id),
+        ('campaign_type', campaign_type, campaign_type),
+    ]
+    for name, low, high in bounds:
+        if low is None and high is None:
+            continue
+        stats = row_group.column(column_index[name]).statistics
+        if stats is None or not stats.has_min_max:
+            continue
+        if low is not None and stats.max < low:
+            return False
+        if high is not None and stats.min > high:
+            return False
+    return True
+
+
+def scan_ad_report_parquet(year_month: str, start_date=None, end_date=None, advertiser_id=None,
+                           campaign_type=None, columns: list[str] | None = None):
+    """
+    扫描 Parquet 分片：按 row group 统计裁剪，只读取需要的列
+
+    裁剪以 row group 为单位，返回的行仍需调用 apply_ad_filters 精确过滤。
+
+    Returns:
+        tuple: (表, 读取的 row group 数, row group 总数)
+    """
+    parquet_path = ADS_SHARDS_DIR / f"ads_{year_month}.parquet"
+    parquet_file = pq.ParquetFile(parquet_path)
+    metadata = parquet_file.metadata
+    column_index = {metadata.schema.column(i).name: i for i in range(metadata.num_columns)}
+
+    row_groups = [
+        i for i in range(metadata.num_row_groups)
+        if parquet_row_group_matches(metadata.row_group(i), column_index, start_date, end_date,
+                                     advertiser_id, campaign_type)
+    ]
+    table = parquet_file.read_row_groups(row_groups, columns=columns)
+    return table, len(row_groups), metadata.num_row_groups
+
+
 def load_ad_report_shards(year_months: list[str]):
     """加载多个月份的广告数据并合并"""
     tables = []
@@ -87,137 +285,133 @@ def load_ad_report_shards(year_months: list[str]):
     return pa.concat_tables(tables)
 
 
-def load_user_sku_logs():
-    """加载用户-SKU互动日志数据"""
-    global _user_sku_logs_table
-    if _user_sku_logs_table is None:
-        with pa.memory_map(str(USER_SKU_LOGS_PATH), 'r') as source:
-            _user_sku_logs_table = ipc.open_file(source).read_all()
-    return _user_sku_logs_table
+def load_user_sku_logs_partitions_metadata():
+    """加载日志分区元数据（metadata.json 被更新后自动重新加载），未分区时返回 None"""
+    global _logs_partitions_metadata, _logs_partitions_metadata_mtime
+    metadata_path = USER_SKU_LOGS_PARTITIONS_DIR / "metadata.json"
+    if not metadata_path.exists():
+        return None
 
+    mtime = metadata_path.stat().st_mtime_ns
+    if _logs_partitions_metadata is None or mtime != _logs_partitions_metadata_mtime:
+        with open(metadata_path) as f:
+            _logs_partitions_metadata = json.load(f)
+        _logs_partitions_metadata_mtime = mtime
+        _logs_partition_tables.clear()
+    return _logs_partitions_metadata
 
-@app.get("/")
-async def root():
-    """健康检查"""
-    return {
-        "service": "Arrow Performance Test API",
-        "status": "ok",
-        "endpoints": {
-            "ad_report": "/api/ad-report",
-            "ad_report_shards_metadata": "/api/ad-report/shards/metadata",
-            "ad_report_shards": "/api/ad-report/shards",
-            "user_sku_logs": "/api/user-sku-logs",
-        }
-    }
 
+def load_user_sku_logs_partition(relative_path: str):
+    """加载单个日志分区（内存映射，零拷贝）"""
+    table = _logs_partition_tables.get(relative_path)
+    if table is None:
+        with pa.memory_map(str(USER_SKU_LOGS_PARTITIONS_DIR / relative_path), 'r') as source:
+            table = ipc.open_file(source).read_all()
+        _logs_partition_tables[relative_path] = table
+    return table
 
-@app.get("/api/ad-report/shards/metadata")
-async def get_ad_report_shards_metadata():
-    """
-    获取广告数据分片元数据
 
-    返回可用的月份列表和统计信息
-    """
-    metadata = load_shards_metadata()
-    if not metadata:
-        raise HTTPException(status_code=404, detail="Shards metadata not found")
+def select_user_sku_logs_partitions(
+    metadata: dict,
+    start_time: datetime | None = None,
+    end_time: datetime | None = None,
+    event_type: str | None = None,
+):
+    """根据分区的时间范围和事件类型计数，选出可能包含匹配记录的分区"""
+    selected = []
+    for partition in metadata['partitions']:
+        if start_time and datetime.fromisoformat(partition['max_ts']) < start_time:
+            continue
+        if end_time and datetime.fromisoformat(partition['min_ts']) > end_time:
+            continue
+        if event_type and not partition['event_counts'].get(event_type):
+            continue
+        selected.append(partition)
+    return selected
 
-    return metadata
 
+def load_user_sku_logs():
+    """加载用户-SKU互动日志数据（全量）"""
+    global _user_sku_logs_table
+    metadata = load_user_sku_logs_partitions_metadata()
+    if metadata is not None:
+        tables = [load_user_sku_logs_partition(p['path']) for p in metadata['partitions']]
+        return pa.concat_tables(tables)
 
-@app.get("/api/ad-report/shards")
-async def get_ad_report_shards(
-    months: str | None = Query(None, description="要加载的月份，逗号分隔，如 '2025-01,2025-02'"),
-    start_date: date | None = Query(None, description="开始日期"),
-    end_date: date | None = Query(None, description="结束日期"),
-    advertiser_id: str | None = Query(None, description="广告主ID"),
-    campaign_type: str | None = Query(None, description="计划类型"),
-):
-    """
-    获取广告日报表分片数据（Arrow格式）
+    if _user_sku_logs_table is None:
+        with pa.memory_map(str(USER_SKU_LOGS_PATH), 'r') as source:
+            _user_sku_logs_table = ipc.open_file(source).read_all()
+    return _user_sku_logs_table
 
-    支持参数：
-    - months: 要加载的月份（逗号分隔），例如 "2025-01,2025-02,2025-03"
-    - start_date: 开始日期
-    - end_date: 结束日期
-    - advertiser_id: 广告主ID
-    - campaign_type: 计划类型
 
-    如果不指定months，将加载所有可用月份
+def load_user_sku_logs_window(
+    start_time: datetime | None = None,
+    end_time: datetime | None = None,
+    event_type: str | None = None,
+):
     """
-    try:
-        # 确定要加载的月份
-        if months:
-            year_months = [m.strip() for m in months.split(',')]
-        else:
-            # 加载所有可用月份
-            metadata = load_shards_metadata()
-            if not metadata:
-                raise HTTPException(status_code=404, detail="Shards metadata not found")
-            year_months = metadata['months']
+    加载时间窗口内的用户-SKU互动日志
 
-        # 加载分片数据
-        table = load_ad_report_shards(year_months)
+    日志按天/小时分区时，只打开与时间窗口重叠且包含该事件类型的分区；
+    未分区时退化为加载整个 user_sku_logs.arrow。
 
-        # 应用过滤条件
-        if start_date:
-            mask = pc.greater_equal(table['date'], pa.scalar(start_date))
-            table = table.filter(mask)
+    Returns:
+        tuple: (table, 读取的分区数, 分区总数)
+    """
+    metadata = load_user_sku_logs_partitions_metadata()
+    if metadata is None:
+        return load_user_sku_logs(), 1, 1
 
-        if end_date:
-            mask = pc.less_equal(table['date'], pa.scalar(end_date))
-            table = table.filter(mask)
+    partitions = select_user_sku_logs_partitions(metadata, start_time, end_time, event_type)
+    tables = [load_user_sku_logs_partition(p['path']) for p in partitions]
+    if not tables:
+        schema = load_user_sku_logs_partition(metadata['partitions'][0]['path']).schema
+        return schema.empty_table(), 0, len(metadata['partitions'])
 
-        if advertiser_id:
-            mask = pc.equal(table['advertiser_id'], pa.scalar(advertiser_id))
-            table = table.filter(mask)
+    return pa.concat_tables(tables), len(partitions), len(metadata['partitions'])
 
-        if campaign_type:
-            mask = pc.equal(table['campaign_type'], pa.scalar(campaign_type))
-            table = table.filter(mask)
 
-        # 序列化为Arrow IPC格式
-        sink = io.BytesIO()
-        with ipc.new_stream(sink, table.schema) as writer:
-            writer.write_table(table)
+def get_user_sku_logs_time_range():
+    """获取用户日志的时间范围，分区存储时直接读取分区元数据"""
+    metadata = load_user_sku_logs_partitions_metadata()
+    if metadata is not None:
+        return (
+            min(datetime.fromisoformat(p['min_ts']) for p in metadata['partitions']),
+            max(datetime.fromisoformat(p['max_ts']) for p in metadata['partitions']),
+        )
 
-        arrow_data = sink.getvalue()
+    min_max = pc.min_max(load_user_sku_logs()['ts']).as_py()
+    return min_max['min'], min_max['max']
 
-        return Response(
-            content=arrow_data,
-            media_type="application/vnd.apache.arrow.stream",
-            headers={
-                "Content-Length": str(len(arrow_data)),
-                "X-Row-Count": str(len(table)),
-                "X-Loaded-Months": ",".join(year_months),
-            }
-        )
 
-    except ValueError as e:
-        raise HTTPException(status_code=400, detail=str(e))
-    except FileNotFoundError as e:
-        raise HTTPException(status_code=404, detail=str(e))
+def months_between(start: date, end: date) -> list[str]:
+    """返回两个日期之间（含）的所有月份，如 ['2025-10', '2025-11']"""
+    months = []
+    year, month = start.year, start.month
+    while (year, month) <= (end.year, end.month):
+        months.append(f"{year:04d}-{month:02d}")
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
 
 
-@app.get("/api/ad-report")
-async def get_ad_report(
-    start_date: date | None = Query(None, description="开始日期"),
-    end_date: date | None = Query(None, description="结束日期"),
-    advertiser_id: int | None = Query(None, description="广告主ID"),
-    campaign_type: str | None = Query(None, description="计划类型"),
-):
+def cache_by_file_version(path: Path, key: tuple, build):
     """
-    获取广告日报表数据（Arrow格式）
+    按文件版本缓存派生数据（草图、统计信息等）
 
-    支持参数：
-    - start_date: 开始日期
-    - end_date: 结束日期
-    - advertiser_id: 广告主ID
-    - campaign_type: 计划类型
+    每个文件只计算一次，文件被重写（mtime/size 变化）后重新计算。
     """
-    table = load_ad_report()
+    stat = path.stat()
+    version = (stat.st_mtime_ns, stat.st_size)
+    cache_key = (str(path),) + key
+    cached = _file_version_cache.get(cache_key)
+    if cached is None or cached[0] != version:
+        cached = (version, build())
+        _file_version_cache[cache_key] = cached
+    return cached[1]
+
 
-    # 应用过滤条件
+def apply_ad_filters(table, start_date=None, end_date=None, advertiser_id=None, campaign_type=None):
+    """对广告数据应用通用过滤条件"""
     if start_date:
         mask = pc.greater_equal(table['date'], pa.scalar(start_date))
         table = table.filter(mask)
@@ -234,42 +428,11 @@ async def get_ad_report(
         mask = pc.equal(table['campaign_type'], pa.scalar(campaign_type))
         table = table.filter(mask)
 
-    # 序列化为Arrow IPC格式
-    sink = io.BytesIO()
-    with ipc.new_stream(sink, table.schema) as writer:
-        writer.write_table(table)
-
-    arrow_data = sink.getvalue()
-
-    return Response(
-        content=arrow_data,
-        media_type="application/vnd.apache.arrow.stream",
-        headers={
-            "Content-Length": str(len(arrow_data)),
-            "X-Row-Count": str(len(table)),
-        }
-    )
-
-
-@app.get("/api/user-sku-logs")
-async def get_user_sku_logs(
-    start_time: datetime | None = Query(None, description="开始时间"),
-    end_time: datetime | None = Query(None, description="结束时间"),
-    event_type: str | None = Query(None, description="事件类型: view, cart_add, purchase"),
-    limit: int | None = Query(None, description="限制返回记录数"),
-):
-    """
-    获取用户-SKU互动日志数据（Arrow格式）
+    return table
 
-    支持参数：
-    - start_time: 开始时间
-    - end_time: 结束时间
-    - event_type: 事件类型
-    - limit: 限制返回记录数
-    """
-    table = load_user_sku_logs()
 
-    # 应用过滤条件
+def apply_log_filters(table, start_time=None, end_time=None, event_type=None):
+    """对用户-SKU日志应用通用过滤条件"""
     if start_time:
         mask = pc.greater_equal(table['ts'], pa.scalar(start_time))
         table = table.filter(mask)
@@ -282,16 +445,153 @@ async def get_user_sku_logs(
         mask = pc.equal(table['event_type'], pa.scalar(event_type))
         table = table.filter(mask)
 
-    # 限制返回记录数
-    if limit and limit > 0:
-        table = table.slice(0, min(limit, len(table)))
+    return table
+
+
+def parse_sample(sample: str) -> tuple[float | None, int | None]:
+    """解析采样参数：小于1的小数为比例，大于等于1的整数为行数"""
+    try:
+        value = float(sample)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid sample: {sample}")
+    if 0 < value < 1:
+        return value, None
+    if value >= 1 and value.is_integer():
+        return None, int(value)
+    raise HTTPException(status_code=400, detail=f"sample must be a fraction in (0, 1) or a row count: {sample}")
+
+
+def sample_table(table, sample: str | None, seed: int = 0, stratify: str | None = None):
+    """
+    确定性行采样
+
+    每行分配一个由 seed 决定的随机数，只对选中的行做 take，不复制整表：
+    - 比例采样：保留随机数小于比例的行，同一 seed 下已有行的取舍不随新追加的行变化
+    - 行数采样：保留随机数最小的 n 行（argpartition，无需完整排序）
+    - 分层采样：按 stratify 列分层，每层按比例（至少1行）或最多 n 行
+    结果保持原始行顺序。
+    """
+    if not sample:
+        return table
+
+    fraction, n = parse_sample(sample)
+    if stratify and stratify not in table.schema.names:
+        raise HTTPException(status_code=400, detail=f"Unknown stratify column: {stratify}")
 
-    # 序列化为Arrow IPC格式
+    num_rows = len(table)
+    keys = np.random.default_rng(seed).random(num_rows)
+
+    if not stratify:
+        if fraction is not None:
+            indices = np.flatnonzero(keys < fraction)
+        elif n >= num_rows:
+            return table
+        else:
+            indices = np.sort(np.argpartition(keys, n)[:n])
+        return table.take(pa.array(indices))
+
+    # 分层：按 (层, 随机数) 排序后计算每行在层内的名次，名次小于该层配额的行被选中
+    strata = pc.dictionary_encode(table[stratify]).combine_chunks().indices.fill_null(-1).to_numpy()
+    order = np.lexsort((keys, strata))
+    sorted_strata = strata[order]
+    boundaries = np.flatnonzero(np.diff(sorted_strata)) + 1
+    starts = np.concatenate([[0], boundaries]) if num_rows else boundaries
+    sizes = np.diff(np.append(starts, num_rows))
+    quotas = np.maximum(1, np.rint(sizes * fraction)).astype(np.int64) if fraction is not None else np.minimum(sizes, n)
+
+    group_index = np.repeat(np.arange(len(starts)), sizes)
+    rank = np.arange(num_rows) - starts[group_index]
+    indices = np.sort(order[rank < quotas[group_index]])
+    return table.take(pa.array(indices))
+
+
+def safe_ratio(numerator, denominator):
+    """逐行计算比率，分母为0时返回null"""
+    numerator = pc.cast(numerator, pa.float64())
+    denominator = pc.cast(denominator, pa.float64())
+    return pc.if_else(
+        pc.greater(denominator, 0),
+        pc.divide(numerator, denominator),
+        pa.scalar(None, pa.float64()),
+    )
+
+
+def encode_join_keys(left, right, keys: list[str]):
+    """
+    将两侧的字符串键编码为共享字典下的 int32 下标
+
+    join 时对定长整数做哈希，避免逐行哈希和比较变长字符串。
+
+    Returns:
+        tuple: (编码后的 left, 编码后的 right, {key: 共享字典})
+    """
+    dictionaries = {}
+    for key in keys:
+        dictionary = pc.unique(pa.chunked_array(left[key].chunks + right[key].chunks, type=left[key].type))
+        dictionaries[key] = dictionary
+        left = left.set_column(
+            left.schema.get_field_index(key), key, pc.index_in(left[key], value_set=dictionary)
+        )
+        right = right.set_column(
+            right.schema.get_field_index(key), key, pc.index_in(right[key], value_set=dictionary)
+        )
+    return left, right, dictionaries
+
+
+def decode_join_keys(table, dictionaries: dict):
+    """将 int32 下标还原为字符串键"""
+    for key, dictionary in dictionaries.items():
+        table = table.set_column(
+            table.schema.get_field_index(key), key, dictionary.take(table[key])
+        )
+    return table
+
+
+def compute_event_funnel(table, group_key: str | None = None):
+    """
+    计算 view → cart_add → purchase 转化漏斗
+
+    用向量化的比较生成事件标记列，再按 group_key 分组求和；
+    group_key 为空时返回整体漏斗（单行）。
+    """
+    event_type = table['event_type']
+    flags = {
+        'views': pc.cast(pc.equal(event_type, 'view'), pa.int64()),
+        'cart_adds': pc.cast(pc.equal(event_type, 'cart_add'), pa.int64()),
+        'purchases': pc.cast(pc.equal(event_type, 'purchase'), pa.int64()),
+    }
+
+    if group_key:
+        grouped = pa.table({group_key: table[group_key], **flags}).group_by(group_key).aggregate(
+            [(name, 'sum') for name in flags]
+        )
+        funnel = pa.table({
+            group_key: grouped[group_key],
+            **{name: grouped[f"{name}_sum"] for name in flags},
+        })
+    else:
+        funnel = pa.table({name: [pc.sum(values).as_py() or 0] for name, values in flags.items()})
+
+    return funnel.append_column(
+        'cart_rate', safe_ratio(funnel['cart_adds'], funnel['views'])
+    ).append_column(
+        'purchase_rate', safe_ratio(funnel['purchases'], funnel['cart_adds'])
+    ).append_column(
+        'overall_rate', safe_ratio(funnel['purchases'], funnel['views'])
+    )
+
+
+def serialize_arrow_stream(table) -> bytes:
+    """将Arrow表序列化为IPC Stream字节"""
     sink = io.BytesIO()
     with ipc.new_stream(sink, table.schema) as writer:
         writer.write_table(table)
+    return sink.getvalue()
 
-    arrow_data = sink.getvalue()
+
+def arrow_stream_response(table, headers: dict | None = None):
+    """将Arrow表序列化为IPC Stream格式的响应"""
+    arrow_data = serialize_arrow_stream(table)
 
     return Response(
         content=arrow_data,
@@ -299,29 +599,1562 @@ async def get_user_sku_logs(
         headers={
             "Content-Length": str(len(arrow_data)),
             "X-Row-Count": str(len(table)),
+            **(headers or {}),
         }
     )
 
 
-@app.get("/api/stats")
-async def get_stats():
-    """获取数据统计信息"""
-    ad_report = load_ad_report()
-    user_sku_logs = load_user_sku_logs()
+EXPORT_FORMATS = ("arrow", "parquet")
 
-    return {
-        "ad_report": {
-            "total_rows": len(ad_report),
-            "file_size_mb": AD_REPORT_PATH.stat().st_size / 1024 / 1024,
-            "schema": str(ad_report.schema),
-        },
-        "user_sku_logs": {
-            "total_rows": len(user_sku_logs),
-            "file_size_mb": USER_SKU_LOGS_PATH.stat().st_size / 1024 / 1024,
-            "schema": str(user_sku_logs.schema),
+
+def serialize_parquet(table) -> bytes:
+    """将Arrow表序列化为Parquet字节（zstd 压缩、字典编码、min/max 统计）"""
+    sink = io.BytesIO()
+    pq.write_table(table, sink, compression='zstd', write_statistics=True)
+    return sink.getvalue()
+
+
+def table_response(table, format: str = "arrow", headers: dict | None = None, filename: str = "export"):
+    """按 format 返回 Arrow IPC Stream 响应或 Parquet 下载"""
+    if format != "parquet":
+        return arrow_stream_response(table, headers)
+
+    parquet_data = serialize_parquet(table)
+    return Response(
+        content=parquet_data,
+        media_type="application/vnd.apache.parquet",
+        headers={
+            "Content-Length": str(len(parquet_data)),
+            "Content-Disposition": f'attachment; filename="{filename}.parquet"',
+            "X-Row-Count": str(len(table)),
+            **(headers or {}),
         }
-    }
+    )
+
+
+def parse_columns(columns: str | None, schema: pa.Schema) -> list[str] | None:
+    """解析逗号分隔的列投影，未指定时返回 None（全部列）"""
+    names = split_ids(columns)
+    if not names:
+        return None
+    unknown = [name for name in names if name not in schema.names]
+    if unknown:
+        raise ValueError(f"Unknown columns: {', '.join(unknown)}")
+    return names
+
+
+def prefault_file(path: Path, chunk_size: int = 8 * 1024 * 1024):
+    """顺序读取整个文件，把页面读入 page cache（内存映射共享同一份页面）"""
+    buffer = bytearray(chunk_size)
+    with open(path, 'rb', buffering=0) as f:
+        while f.readinto(buffer):
+            pass
+
+
+def warm_up():
+    """
+    启动预热
+
+    1. 加载分片和日志分区元数据
+    2. 读取所有数据文件的 footer 统计（/api/stats）
+    3. 内存映射全量广告数据和用户日志
+    4. 加载最近 ARROW_PRELOAD_SHARDS 个月的分片并预计算默认草图
+    5. 可选：预读数据文件到 page cache（ARROW_PRELOAD_PREFAULT=1）
+    """
+    if not PRELOAD_ENABLED:
+        return
+
+    _warmup_state["started_at"] = datetime.now().isoformat()
+
+    # 预热只是优化：单个步骤失败时记录错误并继续，请求时会按需重新加载
+    def step(name, func):
+        start = time.perf_counter()
+        entry = {"name": name}
+        result = None
+        try:
+            result = func()
+        except Exception as e:
+            logger.exception("warm-up %s failed", name)
+            entry["error"] = str(e)
+            _warmup_state["errors"].append({"step": name, "error": str(e)})
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        entry["elapsed_ms"] = round(elapsed_ms, 1)
+        _warmup_state["steps"].append(entry)
+        logger.info("warm-up %s: %.1f ms", name, elapsed_ms)
+        return result
+
+    try:
+        metadata = step("shards_metadata", load_shards_metadata)
+        step("logs_partitions_metadata", load_user_sku_logs_partitions_metadata)
+
+        recent_months = metadata['months'][-PRELOAD_SHARDS:] if metadata and PRELOAD_SHARDS > 0 else []
+        recent_shards = {m: resolve_shard_path(m) for m in recent_months}
+        files = [path for path in recent_shards.values() if path is not None]
+        files += [AD_REPORT_PATH] + user_sku_logs_paths()
+        if PRELOAD_PREFAULT:
+            step("prefault", lambda: [prefault_file(path) for path in files if path.exists()])
+
+        # 所有文件的 footer 统计都很便宜，一并预热 /api/stats
+        all_shards = [resolve_shard_path(m) for m in (metadata['months'] if metadata else [])]
+        step("stats", lambda: [read_file_stats(path) for path in all_shards + files if path and path.exists()])
+
+        if AD_REPORT_PATH.exists():
+            step("ad_report", load_ad_report)
+        if USER_SKU_LOGS_PATH.exists() or USER_SKU_LOGS_PARTITIONS_DIR.exists():
+            step("user_sku_logs", load_user_sku_logs)
+
+        for year_month, shard_path in recent_shards.items():
+            if shard_path is None:
+                continue
+            # 已归档的 Parquet 分片不常驻内存，只预计算草图
+            if shard_path.suffix == ".arrow":
+                step(f"shard_{year_month}", lambda m=year_month: load_ad_report_shard(m))
+            step(f"sketches_{year_month}", lambda m=year_month: (
+                get_ad_shard_sketch(m, 'hll', 'ad_id', None),
+                get_ad_shard_sketch(m, 'quantile', 'cost', None),
+            ))
+
+    except Exception as e:
+        logger.exception("warm-up failed")
+        _warmup_state["errors"].append({"step": None, "error": str(e)})
+    finally:
+        # 预热结束（无论是否有步骤失败）即就绪，只在预热进行中返回 503
+        _warmup_state["ready"] = True
+        _warmup_state["finished_at"] = datetime.now().isoformat()
+
+
+class ExportBudget:
+    """
+    按预估字节数限制同时在途的导出请求
+
+    预算足够时立即放行；否则进入有界队列等待其他请求释放预算，
+    队列已满或等待超时则拒绝。
+    """
+
+    def __init__(self, limit_bytes: int, queue_size: int, timeout: float):
+        self.limit_bytes = limit_bytes
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.inflight_bytes = 0
+        self.inflight_requests = 0
+        self.waiting = 0
+        self.admitted_total = 0
+        self.rejected_total = {"too_large": 0, "busy": 0}
+        self._condition = asyncio.Condition()
+
+    def _fits(self, nbytes: int) -> bool:
+        # 空闲时总是放行一个请求，避免预估值接近上限的请求永远无法执行
+        return self.inflight_requests == 0 or self.inflight_bytes + nbytes <= self.limit_bytes
+
+    async def acquire(self, nbytes: int) -> bool:
+        """申请预算，成功返回 True；队列已满或等待超时返回 False"""
+        async with self._condition:
+            if not self._fits(nbytes):
+                if self.waiting >= self.queue_size:
+                    self.rejected_total["busy"] += 1
+                    return False
+                self.waiting += 1
+                try:
+                    await asyncio.wait_for(self._condition.wait_for(lambda: self._fits(nbytes)), self.timeout)
+                except asyncio.TimeoutError:
+                    self.rejected_total["busy"] += 1
+                    return False
+                finally:
+                    self.waiting -= 1
+
+            self.inflight_bytes += nbytes
+            self.inflight_requests += 1
+            self.admitted_total += 1
+            return True
+
+    async def release(self, nbytes: int):
+        """释放预算并唤醒等待中的请求"""
+        async with self._condition:
+            self.inflight_bytes -= nbytes
+            self.inflight_requests -= 1
+            self._condition.notify_all()
+
+
+export_budget = ExportBudget(MAX_INFLIGHT_BYTES, EXPORT_QUEUE_SIZE, EXPORT_QUEUE_TIMEOUT)
+
+EXPORT_HINT = (
+    "narrow the request with months/start_date/end_date or other filters, use sample=, "
+    "page through /api/ad-report/table, or sync incrementally with /api/ad-report/shards/delta"
+)
+
+
+def month_bounds(year_month: str) -> tuple[date, date]:
+    """返回月份的第一天和最后一天"""
+    year, month = map(int, year_month.split('-'))
+    first = date(year, month, 1)
+    next_first = date(year + 1, 1, 1) if month == 12 else date(year, month + 1, 1)
+    return first, next_first - timedelta(days=1)
+
+
+def estimate_ad_export(year_months: list[str], start_date: date | None = None, end_date: date | None = None):
+    """
+    根据分片 footer 统计预估广告数据导出的行数和字节数（不加载数据）
+
+    日期范围只覆盖月份的一部分时，按覆盖天数比例折算。
+
+    Returns:
+        tuple: (预估行数, 预估字节数)
+    """
+    rows = 0.0
+    size = 0.0
+    for year_month in year_months:
+        shard_path = resolve_shard_path(year_month)
+        if shard_path is None:
+            continue
+        stats = read_file_stats(shard_path)
+        # 已归档的月份按 Parquet 解码后的大小估算
+        size_bytes = stats.get("decoded_bytes", stats["size_bytes"])
+        first, last = month_bounds(year_month)
+        lo = max(first, start_date) if start_date else first
+        hi = min(last, end_date) if end_date else last
+        if lo > hi:
+            continue
+        coverage = ((hi - lo).days + 1) / ((last - first).days + 1)
+        rows += stats["num_rows"] * coverage
+        size += size_bytes * coverage
+    return int(rows), int(size)
+
+
+def estimate_logs_export(start_time: datetime | None = None, end_time: datetime | None = None,
+                         event_type: str | None = None):
+    """
+    根据分区元数据预估用户日志导出的行数和字节数（不加载数据）
+
+    Returns:
+        tuple: (预估行数, 预估字节数)
+    """
+    metadata = load_user_sku_logs_partitions_metadata()
+    if metadata is None:
+        stats = read_file_stats(USER_SKU_LOGS_PATH)
+        return stats["num_rows"], stats["size_bytes"]
+
+    partitions = select_user_sku_logs_partitions(metadata, start_time, end_time, event_type)
+    rows = sum(p['event_counts'].get(event_type, 0) if event_type else p['num_rows'] for p in partitions)
+    size = sum(
+        p['size_bytes'] * p['event_counts'].get(event_type, 0) / p['num_rows'] if event_type else p['size_bytes']
+        for p in partitions
+    )
+    return int(rows), int(size)
+
+
+def scale_export_estimate(rows: int, size: int, sample: str | None = None,
+                          stratify: str | None = None, limit: int | None = None) -> int:
+    """按采样和 limit 折算预估字节数"""
+    if rows == 0:
+        return size
+    bytes_per_row = size / rows
+    if sample:
+        fraction, n = parse_sample(sample)
+        if fraction is not None:
+            rows = rows * fraction
+        elif not stratify:
+            rows = min(rows, n)
+    if limit and limit > 0:
+        rows = min(rows, limit)
+    return int(rows * bytes_per_row)
+
+
+async def admit_export(estimated_bytes: int):
+    """
+    导出准入检查
+
+    预估大小超过 ARROW_MAX_RESPONSE_BYTES 返回 413；
+    在途预算不足且排队失败（队列已满或超时）返回 429。
+    """
+    if estimated_bytes > MAX_RESPONSE_BYTES:
+        export_budget.rejected_total["too_large"] += 1
+        raise HTTPException(
+            status_code=413,
+            detail=f"Estimated response of {estimated_bytes} bytes exceeds limit {MAX_RESPONSE_BYTES}; {EXPORT_HINT}",
+        )
+    if not await export_budget.acquire(estimated_bytes):
+        raise HTTPException(
+            status_code=429,
+            detail=f"Too many large exports in flight; retry later or {EXPORT_HINT}",
+            headers={"Retry-After": str(max(1, int(EXPORT_QUEUE_TIMEOUT)))},
+        )
+
+
+class ExportResponse(Response):
+    """
+    持有导出预算的响应
+
+    无论响应体是否发送成功（客户端断开时 send 会抛异常，BackgroundTask 不会执行），
+    发送结束后都释放预算。
+    """
+
+    def __init__(self, response: Response, estimated_bytes: int):
+        super().__init__(content=response.body, status_code=response.status_code, media_type=response.media_type)
+        self.raw_headers = list(response.raw_headers)
+        self.estimated_bytes = estimated_bytes
+        self.headers["X-Estimated-Bytes"] = str(estimated_bytes)
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await export_budget.release(self.estimated_bytes)
+
+
+def release_after_response(response: Response, estimated_bytes: int):
+    """包装响应，发送结束后（包括发送失败）释放导出预算"""
+    return ExportResponse(response, estimated_bytes)
+
+
+@app.get("/")
+async def root():
+    """健康检查"""
+    return {
+        "service": "Arrow Performance Test API",
+        "status": "ok",
+        "endpoints": {
+            "ready": "/ready",
+            "metrics": "/metrics",
+            "ad_report": "/api/ad-report",
+            "ad_report_shards_metadata": "/api/ad-report/shards/metadata",
+            "ad_report_shards": "/api/ad-report/shards",
+            "ad_report_shards_delta": "/api/ad-report/shards/delta",
+            "ad_report_shards_live": "/api/ad-report/shards/live (WebSocket)",
+            "ad_report_validate": "/api/ad-report/validate",
+            "user_sku_logs": "/api/user-sku-logs",
+            "user_sku_logs_histogram": "/api/user-sku-logs/histogram",
+            "user_sku_logs_funnel": "/api/user-sku-logs/funnel",
+            "attribution": "/api/attribution",
+            "ad_report_table": "/api/ad-report/table",
+            "ad_report_batch": "/api/ad-report/batch",
+            "ad_report_distinct": "/api/ad-report/distinct",
+            "ad_report_quantiles": "/api/ad-report/quantiles",
+            "user_sku_logs_distinct": "/api/user-sku-logs/distinct",
+        }
+    }
+
+
+@app.get("/ready")
+async def ready():
+    """
+    就绪检查
+
+    启动预热进行中返回 503，负载均衡器据此在预热结束后才转发流量；
+    预热中失败的步骤记录在 errors 中，不影响就绪状态
+    """
+    status_code = 200 if _warmup_state["ready"] else 503
+    return JSONResponse(status_code=status_code, content=_warmup_state)
+
+
+@app.get("/metrics")
+async def metrics():
+    """导出准入控制指标（Prometheus 文本格式，按 worker 统计）"""
+    lines = [
+        "# HELP arrow_export_inflight_bytes Estimated bytes of exports currently in flight",
+        "# TYPE arrow_export_inflight_bytes gauge",
+        f"arrow_export_inflight_bytes {export_budget.inflight_bytes}",
+        "# HELP arrow_export_inflight_requests Exports currently in flight",
+        "# TYPE arrow_export_inflight_requests gauge",
+        f"arrow_export_inflight_requests {export_budget.inflight_requests}",
+        "# HELP arrow_export_queue_waiting Exports waiting for budget",
+        "# TYPE arrow_export_queue_waiting gauge",
+        f"arrow_export_queue_waiting {export_budget.waiting}",
+        "# HELP arrow_export_budget_bytes In-flight export budget",
+        "# TYPE arrow_export_budget_bytes gauge",
+        f"arrow_export_budget_bytes {export_budget.limit_bytes}",
+        "# HELP arrow_export_max_response_bytes Estimated size limit of a single export",
+        "# TYPE arrow_export_max_response_bytes gauge",
+        f"arrow_export_max_response_bytes {MAX_RESPONSE_BYTES}",
+        "# HELP arrow_export_admitted_total Exports admitted",
+        "# TYPE arrow_export_admitted_total counter",
+        f"arrow_export_admitted_total {export_budget.admitted_total}",
+        "# HELP arrow_export_rejected_total Exports rejected",
+        "# TYPE arrow_export_rejected_total counter",
+        *(
+            f'arrow_export_rejected_total{{reason="{reason}"}} {count}'
+            for reason, count in export_budget.rejected_total.items()
+        ),
+    ]
+    return PlainTextResponse("\n".join(lines) + "\n")
+
+
+@app.get("/api/ad-report/shards/metadata")
+async def get_ad_report_shards_metadata():
+    """
+    获取广告数据分片元数据
+
+    返回可用的月份列表和统计信息
+    """
+    metadata = load_shards_metadata()
+    if not metadata:
+        raise HTTPException(status_code=404, detail="Shards metadata not found")
+
+    return metadata
+
+
+@app.get("/api/ad-report/shards")
+async def get_ad_report_shards(
+    months: str | None = Query(None, description="要加载的月份，逗号分隔，如 '2025-01,2025-02'"),
+    start_date: date | None = Query(None, description="开始日期"),
+    end_date: date | None = Query(None, description="结束日期"),
+    advertiser_id: str | None = Query(None, description="广告主ID"),
+    campaign_type: str | None = Query(None, description="计划类型"),
+    sample: str | None = Query(None, description="采样：小于1为比例（如 0.1），大于等于1为行数（如 5000）"),
+    seed: int = Query(0, ge=0, description="采样随机种子（非负整数），相同种子返回相同样本"),
+    stratify: str | None = Query(None, description="分层采样的列，如 campaign_type, event_type"),
+    columns: str | None = Query(None, description="只返回指定的列（逗号分隔）"),
+    format: str = Query("arrow", description="响应格式: arrow, parquet"),
+):
+    """
+    获取广告日报表分片数据（Arrow格式）
+
+    支持参数：
+    - months: 要加载的月份（逗号分隔），例如 "2025-01,2025-02,2025-03"
+    - start_date: 开始日期
+    - end_date: 结束日期
+    - advertiser_id: 广告主ID
+    - campaign_type: 计划类型
+    - sample: 采样比例或行数
+    - seed: 采样随机种子
+    - stratify: 分层采样的列
+    - columns: 列投影
+    - format: arrow 返回 IPC Stream，parquet 返回 Parquet 文件下载
+
+    如果不指定months，将加载所有可用月份。
+    只有 Parquet 分片的月份（已归档的冷数据）按 row group 统计裁剪后只读取需要的列。
+    """
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of {EXPORT_FORMATS}")
+
+    try:
+        # 确定要加载的月份
+        if months:
+            year_months = [m.strip() for m in months.split(',')]
+        else:
+            # 加载所有可用月份
+            metadata = load_shards_metadata()
+            if not metadata:
+                raise HTTPException(status_code=404, detail="Shards metadata not found")
+            year_months = metadata['months']
+
+        # 加载前根据分片统计预估响应大小，做准入控制
+        rows, size = estimate_ad_export(year_months, start_date, end_date)
+        estimated_bytes = scale_export_estimate(rows, size, sample, stratify)
+        await admit_export(estimated_bytes)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    try:
+        schema = get_ad_shard_schema(year_months)
+        projection = parse_columns(columns, schema)
+        if projection:
+            # 过滤和分层采样用到的列也要读取，最后再投影
+            required = set(projection) | {'date', 'advertiser_id', 'campaign_type'} | ({stratify} if stratify else set())
+            read_columns = [name for name in schema.names if name in required]
+        else:
+            read_columns = None
+
+        # 加载分片数据：IPC 分片走内存映射缓存，只有 Parquet 分片的月份裁剪 row group 后读取
+        tables = []
+        shard_versions = {}
+        row_groups_scanned = row_groups_total = 0
+        for year_month in year_months:
+            shard_path = resolve_shard_path(year_month)
+            if shard_path is None:
+                continue
+            if shard_path.suffix == ".arrow":
+                table, shard_versions[year_month] = load_ad_report_shard_versioned(year_month)
+                tables.append(table.select(read_columns) if read_columns else table)
+            else:
+                table, scanned, total = scan_ad_report_parquet(
+                    year_month, start_date, end_date, advertiser_id, campaign_type, read_columns
+                )
+                tables.append(table)
+                row_groups_scanned += scanned
+                row_groups_total += total
+
+        if not tables:
+            raise ValueError("No valid shards found")
+        table = pa.concat_tables(tables)
+
+        # 应用过滤条件
+        table = apply_ad_filters(table, start_date, end_date, advertiser_id, campaign_type)
+        unsampled_rows = len(table)
+        table = sample_table(table, sample, seed, stratify)
+        if projection:
+            table = table.select(projection)
+
+        response = table_response(
+            table,
+            format,
+            headers={
+                "X-Unsampled-Row-Count": str(unsampled_rows),
+                "X-Loaded-Months": ",".join(year_months),
+                # 客户端保存各分片版本号，之后通过 /api/ad-report/shards/delta 增量同步
+                "X-Shard-Versions": ",".join(f"{m}:{v}" for m, v in shard_versions.items()),
+                "X-Row-Groups-Scanned": f"{row_groups_scanned}/{row_groups_total}",
+            },
+            filename=f"ads_{year_months[0]}" if len(year_months) == 1 else "ads_shards",
+        )
+    except BaseException as e:
+        await export_budget.release(estimated_bytes)
+        if isinstance(e, ValueError):
+            raise HTTPException(status_code=400, detail=str(e))
+        if isinstance(e, FileNotFoundError):
+            raise HTTPException(status_code=404, detail=str(e))
+        raise
+
+    return release_after_response(response, estimated_bytes)
+
+
+@app.get("/api/ad-report/shards/delta")
+async def get_ad_report_shard_delta(
+    month: str = Query(..., description="月份，如 '2025-11'"),
+    since: int = Query(0, ge=0, description="客户端已有的分片版本号"),
+    start_date: date | None = Query(None, description="开始日期"),
+    end_date: date | None = Query(None, description="结束日期"),
+    advertiser_id: str | None = Query(None, description="广告主ID"),
+    campaign_type: str | None = Query(None, description="计划类型"),
+):
+    """
+    获取分片自指定版本之后新增的数据（Arrow格式）
+
+    分片版本号即文件中的 record batch 数量，只返回第 since 个之后追加的 record batch，
+    过滤条件与 /api/ad-report/shards 一致。当月分片刷新时只需传输新增部分。
+
+    支持参数：
+    - month: 月份
+    - since: 客户端已有的版本号（来自 X-Shard-Versions / X-Shard-Version 响应头）
+
+    如果 since 大于当前版本（分片被重新生成），返回 409，客户端需要重新加载整个分片
+    """
+    try:
+        schema, batches, version = read_shard_batches(month, since)
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+    if since > version:
+        raise HTTPException(
+            status_code=409,
+            detail=f"Shard {month} is at version {version}, older than {since}; reload the full shard",
+        )
+
+    # 新增 batch 来自内存映射，按其大小（过滤前的上限）做准入控制
+    estimated_bytes = sum(batch.nbytes for batch in batches)
+    await admit_export(estimated_bytes)
+
+    try:
+        table = pa.Table.from_batches(batches, schema=schema)
+        table = apply_ad_filters(table, start_date, end_date, advertiser_id, campaign_type)
+
+        response = arrow_stream_response(
+            table,
+            headers={
+                "X-Shard-Version": str(version),
+                "X-Since-Version": str(since),
+            }
+        )
+    except BaseException:
+        await export_budget.release(estimated_bytes)
+        raise
+
+    return release_after_response(response, estimated_bytes)
+
+
+@app.websocket("/api/ad-report/shards/live")
+async def ad_report_shards_live(
+    websocket: WebSocket,
+    month: str | None = Query(None, description="月份，默认跟随最新月份"),
+    since: int | None = Query(None, ge=0, description="客户端已有的分片版本号，默认为当前版本"),
+    start_date: date | None = Query(None, description="开始日期"),
+    end_date: date | None = Query(None, description="结束日期"),
+    advertiser_id: str | None = Query(None, description="广告主ID"),
+    campaign_type: str | None = Query(None, description="计划类型"),
+):
+    """
+    实时推送分片新增的 record batch（WebSocket）
+
+    二进制帧拼接起来是一个 Arrow IPC Stream：第一帧为 schema 消息，
+    之后每帧是一个满足过滤条件的 record batch 消息；schema 帧 + 任一 batch 帧即可单独解码。
+    文本帧为 JSON 控制消息 {"type": "version", "month", "version"}，每次推送后发送，
+    客户端可以据此断线后用 /api/ad-report/shards/delta 补齐。
+
+    不指定 month 时跟随 metadata.json 中的最新月份，新月份出现后从版本 0 开始推送。
+    分片被重新生成（版本号变小）时以 4409 关闭连接，客户端需要重新加载整个分片。
+    """
+    await websocket.accept()
+
+    follow_latest = month is None
+    if follow_latest:
+        metadata = load_shards_metadata()
+        if not metadata or not metadata['months']:
+            await websocket.close(code=4404, reason="Shards metadata not found")
+            return
+        month = metadata['months'][-1]
+
+    try:
+        version = get_shard_version(month)
+    except FileNotFoundError as e:
+        await websocket.close(code=4404, reason=str(e))
+        return
+    schema = read_file_stats(ADS_SHARDS_DIR / f"ads_{month}.arrow")["schema"]
+    if since is None:
+        since = version
+
+    # 客户端消息只用于检测断开
+    receiver = asyncio.create_task(websocket.receive())
+    try:
+        await websocket.send_bytes(schema.serialize().to_pybytes())
+        await websocket.send_json({"type": "version", "month": month, "version": since})
+
+        file_version = None
+        while True:
+            done, _ = await asyncio.wait({receiver}, timeout=LIVE_POLL_INTERVAL)
+            if receiver in done:
+                if receiver.result()["type"] == "websocket.disconnect":
+                    return
+                receiver = asyncio.create_task(websocket.receive())
+
+            if follow_latest:
+                metadata = load_shards_metadata()
+                if metadata and metadata['months'] and metadata['months'][-1] != month:
+                    month, since, file_version = metadata['months'][-1], 0, None
+
+            # 分片文件未变化时不读取 footer
+            shard_path = ADS_SHARDS_DIR / f"ads_{month}.arrow"
+            if not shard_path.exists():
+                continue
+            stat = shard_path.stat()
+            if (stat.st_mtime_ns, stat.st_size) == file_version:
+                continue
+            file_version = (stat.st_mtime_ns, stat.st_size)
+
+            _, batches, version = read_shard_batches(month, since)
+            if version < since:
+                await websocket.close(
+                    code=4409, reason=f"Shard {month} is at version {version}, older than {since}"
+                )
+                return
+            if version == since:
+                continue
+
+            for batch in batches:
+                table = apply_ad_filters(
+                    pa.Table.from_batches([batch]), start_date, end_date, advertiser_id, campaign_type
+                )
+                for filtered in table.to_batches():
+                    if filtered.num_rows:
+                        await websocket.send_bytes(filtered.serialize().to_pybytes())
+
+            since = version
+            await websocket.send_json({"type": "version", "month": month, "version": since})
+    except WebSocketDisconnect:
+        return
+    finally:
+        receiver.cancel()
+
+
+@app.get("/api/ad-report")
+async def get_ad_report(
+    start_date: date | None = Query(None, description="开始日期"),
+    end_date: date | None = Query(None, description="结束日期"),
+    advertiser_id: int | None = Query(None, description="广告主ID"),
+    campaign_type: str | None = Query(None, description="计划类型"),
+    sample: str | None = Query(None, description="采样：小于1为比例（如 0.1），大于等于1为行数（如 5000）"),
+    seed: int = Query(0, ge=0, description="采样随机种子（非负整数），相同种子返回相同样本"),
+    stratify: str | None = Query(None, description="分层采样的列，如 campaign_type, event_type"),
+    format: str = Query("arrow", description="响应格式: arrow, parquet"),
+):
+    """
+    获取广告日报表数据（Arrow格式）
+
+    支持参数：
+    - start_date: 开始日期
+    - end_date: 结束日期
+    - advertiser_id: 广告主ID
+    - campaign_type: 计划类型
+    - sample: 采样比例或行数
+    - seed: 采样随机种子
+    - stratify: 分层采样的列
+    - format: arrow 返回 IPC Stream，parquet 返回 Parquet 文件下载
+    """
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of {EXPORT_FORMATS}")
+
+    # 全量文件与分片内容一致，用分片统计预估响应大小
+    metadata = load_shards_metadata()
+    rows, size = estimate_ad_export(metadata['months'] if metadata else [], start_date, end_date)
+    estimated_bytes = scale_export_estimate(rows, size, sample, stratify)
+    await admit_export(estimated_bytes)
+
+    try:
+        table = load_ad_report()
+
+        # 应用过滤条件
+        table = apply_ad_filters(table, start_date, end_date, advertiser_id, campaign_type)
+        unsampled_rows = len(table)
+        table = sample_table(table, sample, seed, stratify)
+
+        response = table_response(
+            table, format, headers={"X-Unsampled-Row-Count": str(unsampled_rows)}, filename="ads"
+        )
+    except BaseException:
+        await export_budget.release(estimated_bytes)
+        raise
+
+    return release_after_response(response, estimated_bytes)
+
+
+@app.get("/api/user-sku-logs")
+async def get_user_sku_logs(
+    start_time: datetime | None = Query(None, description="开始时间"),
+    end_time: datetime | None = Query(None, description="结束时间"),
+    event_type: str | None = Query(None, description="事件类型: view, cart_add, purchase"),
+    limit: int | None = Query(None, description="限制返回记录数"),
+    sample: str | None = Query(None, description="采样：小于1为比例（如 0.1），大于等于1为行数（如 5000）"),
+    seed: int = Query(0, ge=0, description="采样随机种子（非负整数），相同种子返回相同样本"),
+    stratify: str | None = Query(None, description="分层采样的列，如 campaign_type, event_type"),
+    format: str = Query("arrow", description="响应格式: arrow, parquet"),
+):
+    """
+    获取用户-SKU互动日志数据（Arrow格式）
+
+    支持参数：
+    - start_time: 开始时间
+    - end_time: 结束时间
+    - event_type: 事件类型
+    - limit: 限制返回记录数
+    - sample: 采样比例或行数
+    - seed: 采样随机种子
+    - stratify: 分层采样的列
+    - format: arrow 返回 IPC Stream，parquet 返回 Parquet 文件下载
+    """
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of {EXPORT_FORMATS}")
+
+    rows, size = estimate_logs_export(start_time, end_time, event_type)
+    estimated_bytes = scale_export_estimate(rows, size, sample, stratify, limit)
+    await admit_export(estimated_bytes)
+
+    try:
+        table, scanned, total = load_user_sku_logs_window(start_time, end_time, event_type)
+
+        # 应用过滤条件（分区裁剪后仍需过滤分区边界内的记录）
+        table = apply_log_filters(table, start_time, end_time, event_type)
+        unsampled_rows = len(table)
+        table = sample_table(table, sample, seed, stratify)
+
+        # 限制返回记录数
+        if limit and limit > 0:
+            table = table.slice(0, min(limit, len(table)))
+
+        response = table_response(
+            table,
+            format,
+            headers={
+                "X-Partitions-Scanned": f"{scanned}/{total}",
+                "X-Unsampled-Row-Count": str(unsampled_rows),
+            },
+            filename="user_sku_logs",
+        )
+    except BaseException:
+        await export_budget.release(estimated_bytes)
+        raise
+
+    return release_after_response(response, estimated_bytes)
+
+
+# 转化漏斗支持的分组维度
+FUNNEL_GROUP_KEYS = ('sku_id', 'campaign_id', 'ad_set_id', 'ad_id')
+FUNNEL_SORT_KEYS = ('views', 'cart_adds', 'purchases', 'cart_rate', 'purchase_rate', 'overall_rate')
+
+
+@app.get("/api/user-sku-logs/histogram")
+async def get_user_sku_logs_histogram(
+    start_time: datetime | None = Query(None, description="开始时间"),
+    end_time: datetime | None = Query(None, description="结束时间"),
+    event_type: str | None = Query(None, description="事件类型: view, cart_add, purchase"),
+    interval: str = Query("hour", description="时间粒度: hour, day"),
+):
+    """
+    获取按时间和事件类型统计的事件数量（Arrow格式）
+
+    在服务端对全量日志计算，返回列：<interval>, event_type, count，按时间排序。
+
+    支持参数：
+    - start_time: 开始时间
+    - end_time: 结束时间
+    - event_type: 事件类型
+    - interval: 时间粒度（hour 或 day）
+    """
+    if interval not in ('hour', 'day'):
+        raise HTTPException(status_code=400, detail=f"Unsupported interval: {interval}")
+
+    table, scanned, total = load_user_sku_logs_window(start_time, end_time, event_type)
+    table = apply_log_filters(table.select(['ts', 'event_type']), start_time, end_time, event_type)
+
+    buckets = pa.table({
+        interval: pc.floor_temporal(table['ts'], unit=interval),
+        'event_type': table['event_type'],
+    })
+    histogram = buckets.group_by([interval, 'event_type']).aggregate([([], 'count_all')])
+    histogram = histogram.rename_columns({'count_all': 'count'}).sort_by(
+        [(interval, 'ascending'), ('event_type', 'ascending')]
+    )
+
+    return arrow_stream_response(
+        histogram.select([interval, 'event_type', 'count']),
+        headers={
+            "X-Partitions-Scanned": f"{scanned}/{total}",
+            "X-Event-Count": str(len(table)),
+        }
+    )
+
+
+@app.get("/api/user-sku-logs/funnel")
+async def get_user_sku_logs_funnel(
+    start_time: datetime | None = Query(None, description="开始时间"),
+    end_time: datetime | None = Query(None, description="结束时间"),
+    group_by: str | None = Query(None, description="分组维度: sku_id, campaign_id, ad_set_id, ad_id"),
+    sort_by: str = Query("purchases", description="排序指标"),
+    top_n: int | None = Query(None, ge=1, description="只返回排序指标最高的N组"),
+):
+    """
+    获取 view → cart_add → purchase 转化漏斗（Arrow格式）
+
+    在服务端对全量日志计算，返回列：[group_by], views, cart_adds, purchases,
+    cart_rate, purchase_rate, overall_rate。不指定 group_by 时返回整体漏斗。
+    指定 top_n 时使用 select_k_unstable 做部分选择，无需对所有分组完整排序。
+
+    支持参数：
+    - start_time: 开始时间
+    - end_time: 结束时间
+    - group_by: 分组维度
+    - sort_by: 排序指标（降序）
+    - top_n: 返回的分组数量
+    """
+    if group_by and group_by not in FUNNEL_GROUP_KEYS:
+        raise HTTPException(status_code=400, detail=f"Unsupported group_by: {group_by}")
+    if sort_by not in FUNNEL_SORT_KEYS:
+        raise HTTPException(status_code=400, detail=f"Unsupported sort_by: {sort_by}")
+
+    columns = ['ts', 'event_type'] + ([group_by] if group_by else [])
+    table, scanned, total = load_user_sku_logs_window(start_time, end_time)
+    table = apply_log_filters(table.select(columns), start_time, end_time)
+
+    funnel = compute_event_funnel(table, group_by)
+    total_groups = len(funnel)
+
+    if group_by:
+        # 以分组键作为次排序键，保证相同指标值时结果稳定
+        sort_keys = [(sort_by, 'descending'), (group_by, 'ascending')]
+        if top_n and top_n < total_groups:
+            # 部分选择出前N组后，只需对这N行排序
+            indices = pc.select_k_unstable(funnel, k=top_n, sort_keys=sort_keys)
+            funnel = funnel.take(indices)
+        funnel = funnel.sort_by(sort_keys)
+
+    return arrow_stream_response(
+        funnel,
+        headers={
+            "X-Partitions-Scanned": f"{scanned}/{total}",
+            "X-Total-Groups": str(total_groups),
+        }
+    )
+
+
+# 归因粒度对应的分组键
+ATTRIBUTION_GRAIN_KEYS = {
+    'campaign': ['campaign_id'],
+    'ad_set': ['campaign_id', 'ad_set_id'],
+    'ad': ['campaign_id', 'ad_set_id', 'ad_id'],
+}
+
+
+@app.get("/api/attribution")
+async def get_attribution(
+    grain: str = Query("campaign", description="归因粒度: campaign, ad_set, ad"),
+    daily: bool = Query(False, description="是否按天拆分"),
+    start_date: date | None = Query(None, description="开始日期，默认为日志的起始日期"),
+    end_date: date | None = Query(None, description="结束日期，默认为日志的结束日期"),
+):
+    """
+    广告花费 × 用户购买归因（Arrow格式）
+
+    将广告分片中的花费与用户日志中归因到同一广告的购买事件、购买金额按粒度关联，
+    返回列：<粒度键>, [date], cost, impressions, clicks, purchases, revenue, roas, cost_per_purchase。
+
+    两侧先各自按粒度聚合，再在共享字典编码后的 int32 键上做 full outer hash join，
+    加载前按分片和日志分区统计预估两侧的输入大小，与导出共用准入控制（413/429）；
+    聚合后的 join 输入另受 ARROW_ATTRIBUTION_MAX_JOIN_BYTES 限制，超出时返回 413。
+
+    支持参数：
+    - grain: 归因粒度
+    - daily: 是否按天拆分
+    - start_date: 开始日期
+    - end_date: 结束日期
+    """
+    if grain not in ATTRIBUTION_GRAIN_KEYS:
+        raise HTTPException(status_code=400, detail=f"Unsupported grain: {grain}")
+
+    if start_date is None or end_date is None:
+        logs_start, logs_end = get_user_sku_logs_time_range()
+        start_date = start_date or logs_start.date()
+        end_date = end_date or logs_end.date()
+
+    string_keys = ATTRIBUTION_GRAIN_KEYS[grain]
+    keys = string_keys + (['date'] if daily else [])
+
+    metadata = load_shards_metadata()
+    available_months = set(metadata['months']) if metadata else set()
+    year_months = [m for m in months_between(start_date, end_date) if m in available_months]
+    if not year_months:
+        raise HTTPException(status_code=404, detail="No shards cover the requested date range")
+
+    # 两侧都要先完整加载（Parquet 归档月份需要解码），按加载前的预估大小做准入控制
+    start_time = datetime.combine(start_date, datetime.min.time())
+    end_time = datetime.combine(end_date + timedelta(days=1), datetime.min.time())
+    _, ads_bytes = estimate_ad_export(year_months, start_date, end_date)
+    _, logs_bytes = estimate_logs_export(start_time, end_time, 'purchase')
+    estimated_bytes = int(ads_bytes + logs_bytes)
+    await admit_export(estimated_bytes)
+
+    try:
+        # 广告侧：加载覆盖日期范围的分片，按粒度汇总花费
+        ads = load_ad_report_shards(year_months)
+        ads = apply_ad_filters(ads, start_date, end_date).select(keys + ['cost', 'impressions', 'clicks'])
+        spend = ads.group_by(keys).aggregate([('cost', 'sum'), ('impressions', 'sum'), ('clicks', 'sum')])
+        spend = spend.rename_columns({'cost_sum': 'cost', 'impressions_sum': 'impressions', 'clicks_sum': 'clicks'})
+
+        # 日志侧：只取购买事件，向量化提取 attrs 中的 price 作为购买金额
+        logs, _, _ = load_user_sku_logs_window(start_time, end_time, 'purchase')
+        logs = apply_log_filters(logs.select(['ts', 'event_type'] + string_keys + ['attrs']), start_time, event_type='purchase')
+        logs = logs.filter(pc.less(logs['ts'], pa.scalar(end_time)))
+
+        price = pc.extract_regex(logs['attrs'], r'"price": (?P<price>-?[0-9.]+)')
+        purchase_columns = {key: logs[key] for key in string_keys}
+        if daily:
+            purchase_columns['date'] = pc.cast(logs['ts'], pa.date32())
+        purchase_columns['revenue'] = pc.cast(
+            pc.if_else(pc.is_valid(price), pc.struct_field(price, 'price'), pa.scalar(None, pa.string())),
+            pa.float64(),
+        )
+        purchases = pa.table(purchase_columns).group_by(keys).aggregate([([], 'count_all'), ('revenue', 'sum')])
+        purchases = purchases.rename_columns({'count_all': 'purchases', 'revenue_sum': 'revenue'})
+
+        # 第二道检查：聚合结果仍然过大（粒度过细）时不做 join
+        join_bytes = spend.nbytes + purchases.nbytes
+        if join_bytes > ATTRIBUTION_MAX_JOIN_BYTES:
+            raise HTTPException(
+                status_code=413,
+                detail=f"Join input of {join_bytes} bytes exceeds limit {ATTRIBUTION_MAX_JOIN_BYTES}; narrow the date range or use a coarser grain",
+            )
+
+        spend, purchases, dictionaries = encode_join_keys(spend, purchases, string_keys)
+        # 较小的一侧作为 build 侧（right）构建哈希表
+        if len(spend) < len(purchases):
+            joined = purchases.join(spend, keys=keys, join_type='full outer')
+        else:
+            joined = spend.join(purchases, keys=keys, join_type='full outer')
+        joined = decode_join_keys(joined, dictionaries)
+
+        metrics = {
+            'cost': pc.fill_null(pc.cast(joined['cost'], pa.float64()), 0.0),
+            'impressions': pc.fill_null(joined['impressions'], 0),
+            'clicks': pc.fill_null(joined['clicks'], 0),
+            'purchases': pc.fill_null(joined['purchases'], 0),
+            'revenue': pc.fill_null(joined['revenue'], 0.0),
+        }
+        result = pa.table({
+            **{key: joined[key] for key in keys},
+            **metrics,
+            'roas': safe_ratio(metrics['revenue'], metrics['cost']),
+            'cost_per_purchase': safe_ratio(metrics['cost'], metrics['purchases']),
+        }).sort_by([(key, 'ascending') for key in keys])
+
+        response = arrow_stream_response(
+            result,
+            headers={
+                "X-Loaded-Months": ",".join(year_months),
+                "X-Date-Range": f"{start_date.isoformat()},{end_date.isoformat()}",
+            }
+        )
+    except BaseException:
+        await export_budget.release(estimated_bytes)
+        raise
+
+    return release_after_response(response, estimated_bytes)
+
+
+# 草图支持的列和分组维度
+AD_DISTINCT_COLUMNS = ('advertiser_id', 'campaign_id', 'ad_set_id', 'ad_id')
+AD_QUANTILE_COLUMNS = (
+    'cost', 'impressions', 'reach', 'clicks', 'inline_link_clicks', 'outbound_clicks',
+    'landing_page_view', 'onsite_web_checkout', 'onsite_web_add_to_cart', 'conversions',
+    'onsite_web_checkout_value', 'onsite_web_add_to_cart_value', 'gmv',
+)
+AD_SKETCH_GROUP_KEYS = ('advertiser_id', 'campaign_id', 'campaign_type', 'ad_set_id')
+LOG_DISTINCT_COLUMNS = ('user_id', 'sku_id')
+LOG_SKETCH_GROUP_KEYS = ('event_type', 'campaign_id', 'ad_set_id', 'ad_id', 'sku_id')
+
+
+def parse_quantiles(q: str) -> list[float]:
+    """解析逗号分隔的分位数，如 '0.5,0.9,0.99'"""
+    try:
+        quantiles = [float(v) for v in q.split(',') if v.strip()]
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid quantiles: {q}")
+    if not quantiles or any(not 0 <= v <= 1 for v in quantiles):
+        raise HTTPException(status_code=400, detail=f"Quantiles must be within [0, 1]: {q}")
+    return quantiles
+
+
+def resolve_shard_months(months: str | None) -> list[str]:
+    """解析逗号分隔的月份，未指定时返回所有可用月份（只保留存在的分片）"""
+    if months:
+        year_months = [m.strip() for m in months.split(',')]
+    else:
+        metadata = load_shards_metadata()
+        if not metadata:
+            raise HTTPException(status_code=404, detail="Shards metadata not found")
+        year_months = metadata['months']
+
+    year_months = [m for m in year_months if resolve_shard_path(m) is not None]
+    if not year_months:
+        raise HTTPException(status_code=404, detail="No valid shards found")
+    return year_months
+
+
+def get_ad_shard_sketch(year_month: str, kind: str, column: str, group_by: str | None):
+    """获取单个广告分片的草图（hll 或 quantile），按分片版本缓存"""
+    def build():
+        table = load_ad_report_shard(year_month)
+        groups = table[group_by] if group_by else None
+        if kind == 'hll':
+            return sketches.hll_sketch(table[column], groups)
+        return sketches.quantile_sketch(table[column], groups)
+
+    shard_path = resolve_shard_path(year_month)
+    if shard_path is None:
+        raise FileNotFoundError(f"Shard not found: {year_month}")
+    return cache_by_file_version(shard_path, (kind, column, group_by), build)
+
+
+def sketch_result(estimate: pa.Table, group_by: str | None):
+    """草图估计结果：分组列以分组维度命名，不分组时去掉分组列"""
+    if group_by:
+        return estimate.rename_columns({'group': group_by}).sort_by(group_by)
+    return estimate.drop_columns(['group'])
+
+
+@app.get("/api/ad-report/distinct")
+async def get_ad_report_distinct(
+    column: str = Query("ad_id", description="去重计数的列: advertiser_id, campaign_id, ad_set_id, ad_id"),
+    group_by: str | None = Query(None, description="分组维度: advertiser_id, campaign_id, campaign_type, ad_set_id"),
+    months: str | None = Query(None, description="月份，逗号分隔，默认所有月份"),
+):
+    """
+    近似 distinct count（HyperLogLog，Arrow格式）
+
+    每个分片的草图只计算一次并缓存，查询时合并所选月份的草图，耗时与行数无关。
+    返回列：[group_by], distinct_count
+    """
+    if column not in AD_DISTINCT_COLUMNS:
+        raise HTTPException(status_code=400, detail=f"Unsupported column: {column}")
+    if group_by and group_by not in AD_SKETCH_GROUP_KEYS:
+        raise HTTPException(status_code=400, detail=f"Unsupported group_by: {group_by}")
+
+    year_months = resolve_shard_months(months)
+    shard_sketches = [get_ad_shard_sketch(m, 'hll', column, group_by) for m in year_months]
+    merged = sketches.merge_hll(shard_sketches)
+
+    return arrow_stream_response(
+        sketch_result(sketches.hll_estimate(merged), group_by),
+        headers={"X-Loaded-Months": ",".join(year_months)}
+    )
+
+
+@app.get("/api/ad-report/quantiles")
+async def get_ad_report_quantiles(
+    column: str = Query("cost", description="数值列，如 cost, impressions, gmv"),
+    group_by: str | None = Query(None, description="分组维度: advertiser_id, campaign_id, campaign_type, ad_set_id"),
+    months: str | None = Query(None, description="月份，逗号分隔，默认所有月份"),
+    q: str = Query("0.5,0.9,0.99", description="分位数，逗号分隔"),
+):
+    """
+    近似分位数（对数分桶草图，相对误差 1%，Arrow格式）
+
+    对 ad 日报行的指标计算分布，每个分片的草图只计算一次并缓存，查询时合并。
+    返回列：[group_by], count, p50, p90, ...
+    """
+    if column not in AD_QUANTILE_COLUMNS:
+        raise HTTPException(status_code=400, detail=f"Unsupported column: {column}")
+    if group_by and group_by not in AD_SKETCH_GROUP_KEYS:
+        raise HTTPException(status_code=400, detail=f"Unsupported group_by: {group_by}")
+    quantiles = parse_quantiles(q)
+
+    year_months = resolve_shard_months(months)
+    shard_sketches = [get_ad_shard_sketch(m, 'quantile', column, group_by) for m in year_months]
+    merged = sketches.merge_quantile_sketches(shard_sketches)
+
+    return arrow_stream_response(
+        sketch_result(sketches.quantile_estimate(merged, quantiles), group_by),
+        headers={"X-Loaded-Months": ",".join(year_months)}
+    )
+
+
+@app.get("/api/user-sku-logs/distinct")
+async def get_user_sku_logs_distinct(
+    column: str = Query("user_id", description="去重计数的列: user_id, sku_id"),
+    group_by: str | None = Query(None, description="分组维度: event_type, campaign_id, ad_set_id, ad_id, sku_id"),
+    start_time: datetime | None = Query(None, description="开始时间"),
+    end_time: datetime | None = Query(None, description="结束时间"),
+    event_type: str | None = Query(None, description="事件类型: view, cart_add, purchase"),
+):
+    """
+    用户日志近似 distinct count（HyperLogLog，Arrow格式）
+
+    完全落在时间窗口内的分区使用缓存的分区草图，只有窗口边界上的分区需要按行过滤后现算。
+    返回列：[group_by], distinct_count
+    """
+    if column not in LOG_DISTINCT_COLUMNS:
+        raise HTTPException(status_code=400, detail=f"Unsupported column: {column}")
+    if group_by and group_by not in LOG_SKETCH_GROUP_KEYS:
+        raise HTTPException(status_code=400, detail=f"Unsupported group_by: {group_by}")
+
+    def build(table):
+        table = apply_log_filters(table, start_time, end_time, event_type)
+        return sketches.hll_sketch(table[column], table[group_by] if group_by else None)
+
+    metadata = load_user_sku_logs_partitions_metadata()
+    if metadata is None:
+        sources = [(USER_SKU_LOGS_PATH, load_user_sku_logs, start_time is None and end_time is None)]
+    else:
+        sources = [
+            (
+                USER_SKU_LOGS_PARTITIONS_DIR / p['path'],
+                lambda path=p['path']: load_user_sku_logs_partition(path),
+                (start_time is None or datetime.fromisoformat(p['min_ts']) >= start_time)
+                and (end_time is None or datetime.fromisoformat(p['max_ts']) <= end_time),
+            )
+            for p in select_user_sku_logs_partitions(metadata, start_time, end_time, event_type)
+        ]
+
+    partition_sketches = [
+        cache_by_file_version(path, ('hll', column, group_by, event_type), lambda load=load: build(load()))
+        if fully_covered else build(load())
+        for path, load, fully_covered in sources
+    ]
+    if not partition_sketches:
+        partition_sketches = [build(load_user_sku_logs_window(start_time, end_time, event_type)[0])]
+    merged = sketches.merge_hll(partition_sketches)
+
+    return arrow_stream_response(
+        sketch_result(sketches.hll_estimate(merged), group_by),
+        headers={"X-Partitions-Scanned": str(len(sources))}
+    )
+
+
+# 广告明细表各层级的分组键（第一个为该层级的ID）
+AD_TABLE_LEVEL_KEYS = {
+    'ad_account': ['advertiser_id'],
+    'campaign': ['campaign_id', 'campaign_type', 'advertiser_id'],
+    'ad_set': ['ad_set_id', 'campaign_id'],
+    'ad': ['ad_id', 'ad_set_id', 'campaign_id'],
+}
+AD_TABLE_METRICS = ('impressions', 'clicks', 'cost', 'conversions', 'gmv')
+AD_TABLE_SORT_KEYS = AD_TABLE_METRICS + ('ctr', 'cvr', 'roi')
+
+
+def split_ids(ids: str | None) -> list[str]:
+    """解析逗号分隔的ID列表"""
+    return [v.strip() for v in ids.split(',') if v.strip()] if ids else []
+
+
+def aggregate_ad_table(table, level: str):
+    """按层级汇总广告指标并派生 ctr/cvr/roi（百分比）"""
+    keys = AD_TABLE_LEVEL_KEYS[level]
+    grouped = table.select(keys + list(AD_TABLE_METRICS)).group_by(keys).aggregate(
+        [(metric, 'sum') for metric in AD_TABLE_METRICS]
+    )
+    result = pa.table({
+        **{key: grouped[key] for key in keys},
+        **{metric: grouped[f"{metric}_sum"] for metric in AD_TABLE_METRICS},
+    })
+    return result.append_column(
+        'ctr', pc.multiply(safe_ratio(result['clicks'], result['impressions']), 100)
+    ).append_column(
+        'cvr', pc.multiply(safe_ratio(result['conversions'], result['clicks']), 100)
+    ).append_column(
+        'roi', pc.multiply(pc.subtract(safe_ratio(result['gmv'], result['cost']), 1), 100)
+    )
+
+
+@app.get("/api/ad-report/table")
+async def get_ad_report_table(
+    level: str = Query("ad", description="层级: ad_account, campaign, ad_set, ad"),
+    sort_by: str = Query("cost", description="排序指标: impressions, clicks, cost, conversions, gmv, ctr, cvr, roi"),
+    order: str = Query("desc", description="排序方向: asc, desc"),
+    offset: int = Query(0, ge=0, description="分页偏移"),
+    limit: int = Query(50, ge=1, le=1000, description="每页行数"),
+    months: str | None = Query(None, description="月份，逗号分隔，默认所有月份"),
+    start_date: date | None = Query(None, description="开始日期"),
+    end_date: date | None = Query(None, description="结束日期"),
+    campaign_type: str | None = Query(None, description="计划类型"),
+    advertiser_ids: str | None = Query(None, description="只包含这些广告主，逗号分隔"),
+    campaign_ids: str | None = Query(None, description="只包含这些广告系列，逗号分隔"),
+    ad_set_ids: str | None = Query(None, description="只包含这些广告组，逗号分隔"),
+):
+    """
+    广告明细表服务端汇总、排序和分页（Arrow格式）
+
+    在服务端按层级汇总后只返回请求的一页，响应头 X-Total-Count 为汇总后的总行数。
+    排序使用 select_k_unstable 部分选择出 offset + limit 行后再排序，不对所有分组完整排序。
+    上级ID筛选与明细表的勾选联动一致（账户 → 系列 → 广告组）。
+    """
+    if level not in AD_TABLE_LEVEL_KEYS:
+        raise HTTPException(status_code=400, detail=f"Unsupported level: {level}")
+    if sort_by not in AD_TABLE_SORT_KEYS:
+        raise HTTPException(status_code=400, detail=f"Unsupported sort_by: {sort_by}")
+    if order not in ('asc', 'desc'):
+        raise HTTPException(status_code=400, detail=f"Unsupported order: {order}")
+
+    year_months = resolve_shard_months(months)
+    table = load_ad_report_shards(year_months)
+    table = apply_ad_filters(table, start_date, end_date, campaign_type=campaign_type)
+
+    for column, ids in (
+        ('advertiser_id', split_ids(advertiser_ids)),
+        ('campaign_id', split_ids(campaign_ids)),
+        ('ad_set_id', split_ids(ad_set_ids)),
+    ):
+        if ids:
+            table = table.filter(pc.is_in(table[column], value_set=pa.array(ids)))
+
+    aggregated = aggregate_ad_table(table, level)
+    total_count = len(aggregated)
+
+    # 以层级ID作为次排序键，保证翻页时顺序稳定
+    sort_keys = [(sort_by, 'ascending' if order == 'asc' else 'descending'), (AD_TABLE_LEVEL_KEYS[level][0], 'ascending')]
+    k = offset + limit
+    if k < total_count:
+        aggregated = aggregated.take(pc.select_k_unstable(aggregated, k=k, sort_keys=sort_keys))
+    page = aggregated.sort_by(sort_keys).slice(offset, limit)
+
+    return arrow_stream_response(
+        page,
+        headers={
+            "X-Total-Count": str(total_count),
+            "X-Loaded-Months": ",".join(year_months),
+        }
+    )
+
+
+# 批量查询支持的聚合函数
+BATCH_AGGREGATE_OPS = ('sum', 'mean', 'min', 'max', 'count', 'count_distinct')
+
+
+class AdFilters(BaseModel):
+    """广告数据过滤条件"""
+    start_date: date | None = None
+    end_date: date | None = None
+    advertiser_id: str | None = None
+    campaign_type: str | None = None
+
+
+class BatchAggregate(BaseModel):
+    """聚合项，结果列名为 <column>_<op>"""
+    column: str
+    op: str = "sum"
+
+
+class BatchSubQuery(BaseModel):
+    """批量查询中的一个子查询"""
+    name: str = Field(..., pattern=r"^[A-Za-z0-9_\-]+$", description="结果名称，对应响应中的一个 part")
+    filters: AdFilters | None = Field(None, description="在共享基础数据上追加的过滤条件")
+    columns: list[str] | None = Field(None, description="列投影（不聚合时）")
+    group_by: list[str] = Field(default_factory=list, description="分组列")
+    aggregates: list[BatchAggregate] = Field(default_factory=list, description="聚合项")
+    sort_by: list[tuple[str, str]] = Field(default_factory=list, description="排序，如 [['cost_sum', 'descending']]")
+    limit: int | None = Field(None, ge=1, description="返回行数上限")
+
+
+class BatchQueryRequest(BaseModel):
+    """批量查询请求：所有子查询共享同一组分片和基础过滤条件"""
+    months: list[str] | None = Field(None, description="要加载的月份，默认所有月份")
+    filters: AdFilters = Field(default_factory=AdFilters, description="基础过滤条件")
+    queries: list[BatchSubQuery] = Field(..., min_length=1)
+
+
+def run_batch_sub_query(base, query: BatchSubQuery):
+    """在已过滤的基础数据上执行一个子查询"""
+    schema_names = set(base.schema.names)
+    referenced = set(query.columns or []) | set(query.group_by) | {agg.column for agg in query.aggregates}
+    unknown = referenced - schema_names
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Query '{query.name}': unknown columns {sorted(unknown)}")
+    for agg in query.aggregates:
+        if agg.op not in BATCH_AGGREGATE_OPS:
+            raise HTTPException(status_code=400, detail=f"Query '{query.name}': unsupported op {agg.op}")
+
+    table = base
+    if query.filters:
+        table = apply_ad_filters(table, **query.filters.model_dump())
+
+    if query.group_by or query.aggregates:
+        table = table.group_by(query.group_by).aggregate([(agg.column, agg.op) for agg in query.aggregates])
+    elif query.columns:
+        table = table.select(query.columns)
+
+    if query.sort_by:
+        unknown = {column for column, _ in query.sort_by} - set(table.schema.names)
+        if unknown or any(order not in ('ascending', 'descending') for _, order in query.sort_by):
+            raise HTTPException(status_code=400, detail=f"Query '{query.name}': invalid sort_by {query.sort_by}")
+        if query.limit and query.limit < len(table):
+            table = table.take(pc.select_k_unstable(table, k=query.limit, sort_keys=query.sort_by))
+        table = table.sort_by(query.sort_by)
+
+    if query.limit:
+        table = table.slice(0, query.limit)
+
+    return table
+
+
+@app.post("/api/ad-report/batch")
+async def post_ad_report_batch(request: BatchQueryRequest):
+    """
+    批量查询：一次请求返回多个Arrow表
+
+    只加载一次所选分片并应用基础过滤条件，再在同一份数据上依次执行各子查询
+    （追加过滤、列投影、分组聚合、排序、限制行数）。
+
+    响应为 multipart/form-data，每个子查询一个 part（name 为子查询名称，内容为 Arrow IPC Stream），
+    浏览器端可以直接用 response.formData() 解析。
+    """
+    names = [query.name for query in request.queries]
+    if len(set(names)) != len(names):
+        raise HTTPException(status_code=400, detail="Query names must be unique")
+
+    year_months = resolve_shard_months(",".join(request.months) if request.months else None)
+
+    # 聚合子查询的结果很小；不聚合的子查询按基础数据（日期范围折算、limit）预估
+    rows, size = estimate_ad_export(year_months, request.filters.start_date, request.filters.end_date)
+    estimated_bytes = sum(
+        scale_export_estimate(rows, size, limit=query.limit)
+        for query in request.queries
+        if not (query.group_by or query.aggregates)
+    )
+    await admit_export(estimated_bytes)
+
+    try:
+        base = load_ad_report_shards(year_months)
+        base = apply_ad_filters(base, **request.filters.model_dump())
+
+        boundary = uuid.uuid4().hex
+        parts = []
+        for query in request.queries:
+            result = run_batch_sub_query(base, query)
+            parts.append(
+                (
+                    f"--{boundary}\r\n"
+                    f"Content-Disposition: form-data; name=\"{query.name}\"; filename=\"{query.name}.arrow\"\r\n"
+                    f"Content-Type: application/vnd.apache.arrow.stream\r\n"
+                    f"X-Row-Count: {len(result)}\r\n\r\n"
+                ).encode()
+                + serialize_arrow_stream(result)
+                + b"\r\n"
+            )
+        body = b"".join(parts) + f"--{boundary}--\r\n".encode()
+
+        response = Response(
+            content=body,
+            media_type=f"multipart/form-data; boundary={boundary}",
+            headers={
+                "Content-Length": str(len(body)),
+                "X-Base-Row-Count": str(len(base)),
+                "X-Loaded-Months": ",".join(year_months),
+            }
+        )
+    except BaseException:
+        await export_budget.release(estimated_bytes)
+        raise
+
+    return release_after_response(response, estimated_bytes)
+
+
+def read_file_stats(path: Path):
+    """
+    读取 IPC 或 Parquet 文件的基础统计信息（按文件版本缓存）
+
+    行数、record batch 数和每列 null 计数都来自 footer 和 batch 元数据，
+    内存映射下不读取数据页。Parquet 文件的 batch 数为 row group 数，
+    null 计数来自 row group 统计，另外返回解码后的大小 decoded_bytes。
+    """
+    def build_parquet():
+        metadata = pq.read_metadata(path)
+        schema = metadata.schema.to_arrow_schema()
+        null_counts = dict.fromkeys(schema.names, 0)
+        decoded_bytes = 0
+        for i in range(metadata.num_row_groups):
+            row_group = metadata.row_group(i)
+            decoded_bytes += row_group.total_byte_size
+            for j in range(row_group.num_columns):
+                column = row_group.column(j)
+                if column.statistics is not None and column.statistics.has_null_count:
+                    null_counts[column.path_in_schema] += column.statistics.null_count
+        return {
+            "num_rows": metadata.num_rows,
+            "num_batches": metadata.num_row_groups,
+            "size_bytes": path.stat().st_size,
+            "decoded_bytes": decoded_bytes,
+            "schema": schema,
+            "null_counts": null_counts,
+        }
+
+    def build():
+        if path.suffix == ".parquet":
+            return build_parquet()
+        with pa.memory_map(str(path), 'r') as source:
+            reader = ipc.open_file(source)
+            num_rows = 0
+            null_counts = dict.fromkeys(reader.schema.names, 0)
+            for i in range(reader.num_record_batches):
+                batch = reader.get_batch(i)
+                num_rows += batch.num_rows
+                for name, column in zip(batch.schema.names, batch.columns):
+                    null_counts[name] += column.null_count
+            return {
+                "num_rows": num_rows,
+                "num_batches": reader.num_record_batches,
+                "size_bytes": path.stat().st_size,
+                "schema": reader.schema,
+                "null_counts": null_counts,
+            }
+
+    return cache_by_file_version(path, ('stats',), build)
+
+
+def read_column_stats(path: Path):
+    """
+    计算 IPC 或 Parquet 文件每列的 min/max 和 distinct 草图（按文件版本缓存）
+
+    需要读取数据页，每个文件版本只计算一次；多个文件的草图可以合并。
+    """
+    def build():
+        table = read_shard_file(path)
+
+        columns = {}
+        for name in table.schema.names:
+            column = table[name]
+            min_max = pc.min_max(column).as_py() if len(column) else {"min": None, "max": None}
+            values = column if pa.types.is_string(column.type) else pc.cast(column, pa.string())
+            columns[name] = {
+                "min": min_max["min"],
+                "max": min_max["max"],
+                "sketch": sketches.hll_sketch(values),
+            }
+        return columns
+
+    return cache_by_file_version(path, ('column_stats',), build)
+
+
+def json_scalar(value):
+    """将统计值转换为可JSON序列化的形式"""
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return value
+
+
+def dataset_stats(paths: list[Path], detail: bool = False):
+    """
+    汇总多个 IPC 或 Parquet 文件（分片/分区）的统计信息
+
+    detail 为 True 时包含每列的 min/max 和近似 distinct count（合并各文件的草图）。
+    """
+    if not paths:
+        return {"total_rows": 0, "file_size_mb": 0.0, "num_files": 0, "num_batches": 0, "schema": None, "columns": {}}
+
+    file_stats = [read_file_stats(path) for path in paths]
+    schema = file_stats[0]["schema"]
+    stats = {
+        "total_rows": sum(f["num_rows"] for f in file_stats),
+        "file_size_mb": sum(f["size_bytes"] for f in file_stats) / 1024 / 1024,
+        "num_files": len(file_stats),
+        "num_batches": sum(f["num_batches"] for f in file_stats),
+        "schema": str(schema),
+        "columns": {
+            name: {
+                "type": str(schema.field(name).type),
+                "null_count": sum(f["null_counts"][name] for f in file_stats),
+            }
+            for name in schema.names
+        },
+    }
+
+    if detail:
+        column_stats = [read_column_stats(path) for path in paths]
+        for name, column in stats["columns"].items():
+            mins = [c[name]["min"] for c in column_stats if c[name]["min"] is not None]
+            maxs = [c[name]["max"] for c in column_stats if c[name]["max"] is not None]
+            estimate = sketches.hll_estimate(
+                sketches.merge_hll([c[name]["sketch"] for c in column_stats], by_group=False)
+            )
+            column["min"] = json_scalar(min(mins)) if mins else None
+            column["max"] = json_scalar(max(maxs)) if maxs else None
+            column["distinct_estimate"] = estimate["distinct_count"][0].as_py() if len(estimate) else 0
+
+    return stats
+
+
+def user_sku_logs_paths() -> list[Path]:
+    """用户日志的数据文件：分区存储时为所有分区文件"""
+    metadata = load_user_sku_logs_partitions_metadata()
+    if metadata is None:
+        return [USER_SKU_LOGS_PATH]
+    return [USER_SKU_LOGS_PARTITIONS_DIR / p['path'] for p in metadata['partitions']]
+
+
+@app.get("/api/ad-report/validate")
+async def validate_ad_report_shards(
+    months: str | None = Query(None, description="要校验的月份（逗号分隔），默认全部"),
+    samples: int = Query(validation.DEFAULT_SAMPLE_SIZE, ge=0, le=100, description="每项检查返回的违规样本数"),
+):
+    """
+    校验广告数据分片的数据质量
+
+    漏斗不变量、指标非负、分片之间不重叠、层级关系唯一、ad 生命周期连续、元数据一致，
+    各分片在线程池中并行校验。返回每项检查的违规数和样本行，passed 为 false 表示存在违规。
+    """
+    try:
+        return await asyncio.to_thread(validation.validate_shards, ADS_SHARDS_DIR, split_ids(months) or None, samples)
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.get("/api/stats")
+async def get_stats(
+    detail: bool = Query(False, description="是否包含每列的 min/max 和近似 distinct count"),
+):
+    """
+    获取数据统计信息
+
+    行数、文件大小、schema 和每列 null 计数只读取 IPC footer 和 batch 元数据，不加载数据；
+    detail=true 时额外返回每列 min/max 和近似 distinct count，每个文件版本只计算一次并缓存。
+    """
+    stats = {}
+    if AD_REPORT_PATH.exists():
+        stats["ad_report"] = dataset_stats([AD_REPORT_PATH], detail)
+
+    metadata = load_shards_metadata()
+    if metadata:
+        shard_paths = [resolve_shard_path(m) for m in metadata['months']]
+        stats["ads_shards"] = dataset_stats([p for p in shard_paths if p is not None], detail)
+
+    stats["user_sku_logs"] = dataset_stats(user_sku_logs_paths(), detail)
 
+    return stats
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,258 @@
+"""
+可合并的近似统计草图（sketch）
+
+用于大规模聚合的近似去重计数和分位数：
+1. HyperLogLog：近似 distinct count
+2. 对数分桶分位数草图（DDSketch）：相对误差有界的近似分位数
+
+两类草图都以稀疏的 Arrow 表表示，每行是 (group, 桶/寄存器, 值)：
+- 按分片/分区预先计算后缓存，查询时 concat 后再做一次 group_by 即可合并
+- 合并结果的大小受 分组数 × 寄存器/桶数 限制，与原始行数无关
+- group 列为 null 表示不分组
+"""
+
+import math
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# HyperLogLog 精度：2^14 个寄存器，标准误差约 0.8%
+HLL_PRECISION = 14
+
+# 分位数草图的相对误差
+QUANTILE_RELATIVE_ACCURACY = 0.01
+
+# 非正数统一落入该桶，估计值为 0
+NON_POSITIVE_BUCKET = -(2 ** 31)
+
+_FNV_OFFSET = np.uint64(0xcbf29ce484222325)
+_FNV_PRIME = np.uint64(0x100000001b3)
+
+
+def _fmix64(h):
+    """MurmurHash3 的 64 位终结混合，让 FNV 哈希的各比特分布均匀"""
+    h = h ^ (h >> np.uint64(33))
+    h = h * np.uint64(0xff51afd7ed558ccd)
+    h = h ^ (h >> np.uint64(33))
+    h = h * np.uint64(0xc4ceb9fe1a85ec53)
+    h = h ^ (h >> np.uint64(33))
+    return h
+
+
+def hash_strings(values) -> np.ndarray:
+    """
+    向量化计算字符串的 64 位哈希（FNV-1a + fmix64）
+
+    直接读取 Arrow 字符串数组的 offsets/data 缓冲区，按字符位置逐列计算，
+    循环次数等于最长字符串长度，而不是行数。values 不能包含 null。
+    """
+    if isinstance(values, pa.ChunkedArray):
+        values = values.combine_chunks()
+    values = values.cast(pa.large_string())
+    n = len(values)
+    if n == 0:
+        return np.empty(0, dtype=np.uint64)
+
+    _, offsets_buffer, data_buffer = values.buffers()
+    offsets = np.frombuffer(offsets_buffer, dtype=np.int64)[values.offset:values.offset + n + 1]
+    data = np.frombuffer(data_buffer, dtype=np.uint8) if data_buffer is not None else np.zeros(1, np.uint8)
+    starts = offsets[:-1]
+    lengths = offsets[1:] - starts
+
+    h = np.full(n, _FNV_OFFSET, dtype=np.uint64)
+    for position in range(int(lengths.max())):
+        active = lengths > position
+        index = np.where(active, starts + position, 0)
+        mixed = (h ^ data[index].astype(np.uint64)) * _FNV_PRIME
+        h = np.where(active, mixed, h)
+
+    return _fmix64(h ^ lengths.astype(np.uint64))
+
+
+def _group_column(groups, n: int):
+    """规范化分组列：None 表示不分组（全部为 null）"""
+    if groups is None:
+        return pa.nulls(n, pa.string())
+    if isinstance(groups, pa.ChunkedArray):
+        groups = groups.combine_chunks()
+    return groups
+
+
+def hll_sketch(values, groups=None, precision: int = HLL_PRECISION) -> pa.Table:
+    """
+    构建稀疏 HyperLogLog 草图
+
+    Args:
+        values: 需要去重计数的字符串列
+        groups: 分组列（可选）
+        precision: 寄存器数量为 2^precision
+
+    Returns:
+        pa.Table: 列 group, register, rho（每个分组、寄存器的最大 rho）
+    """
+    table = pa.table({
+        'group': _group_column(groups, len(values)),
+        'value': values,
+    }).filter(pc.is_valid(values))
+
+    # 同一分组内重复值只需哈希一次
+    table = table.group_by(['group', 'value']).aggregate([])
+    hashes = hash_strings(table['value'])
+
+    remaining_bits = 64 - precision
+    registers = (hashes >> np.uint64(remaining_bits)).astype(np.int32)
+    remainder = (hashes & np.uint64((1 << remaining_bits) - 1)).astype(np.float64)
+    _, bit_length = np.frexp(remainder)
+    rho = (remaining_bits - bit_length + 1).astype(np.int8)
+
+    sketch = pa.table({
+        'group': table['group'],
+        'register': pa.array(registers, pa.int32()),
+        'rho': pa.array(rho, pa.int8()),
+    })
+    return merge_hll([sketch])
+
+
+def merge_hll(sketches: list[pa.Table], by_group: bool = True) -> pa.Table:
+    """
+    合并多个 HyperLogLog 草图（同一寄存器取最大 rho）
+
+    by_group 为 False 时忽略分组，得到所有分组并集的草图。
+    """
+    table = pa.concat_tables(sketches)
+    if not by_group:
+        table = table.set_column(0, 'group', pa.nulls(len(table), pa.string()))
+    merged = table.group_by(['group', 'register']).aggregate([('rho', 'max')])
+    return merged.rename_columns({'rho_max': 'rho'}).select(['group', 'register', 'rho'])
+
+
+def hll_estimate(sketch: pa.Table, precision: int = HLL_PRECISION) -> pa.Table:
+    """
+    根据 HyperLogLog 草图估计每个分组的 distinct count
+
+    Returns:
+        pa.Table: 列 group, distinct_count
+    """
+    m = 1 << precision
+    alpha = 0.7213 / (1 + 1.079 / m)
+
+    inverse = pc.power(2.0, pc.negate(pc.cast(sketch['rho'], pa.float64())))
+    per_group = pa.table({'group': sketch['group'], 'inverse': inverse}).group_by('group').aggregate(
+        [('inverse', 'sum'), ([], 'count_all')]
+    )
+
+    # 未出现的寄存器值为 0，贡献 2^0 = 1
+    zeros = m - per_group['count_all'].to_numpy().astype(np.float64)
+    harmonic = per_group['inverse_sum'].to_numpy() + zeros
+    raw = alpha * m * m / harmonic
+
+    # 小基数时使用线性计数修正
+    with np.errstate(divide='ignore'):
+        linear = m * np.log(m / np.maximum(zeros, 1))
+    estimate = np.where((raw <= 2.5 * m) & (zeros > 0), linear, raw)
+
+    return pa.table({
+        'group': per_group['group'],
+        'distinct_count': pa.array(np.rint(estimate).astype(np.int64)),
+    })
+
+
+def quantile_sketch(values, groups=None, relative_accuracy: float = QUANTILE_RELATIVE_ACCURACY) -> pa.Table:
+    """
+    构建对数分桶的分位数草图（DDSketch）
+
+    正数 x 落入桶 ceil(log_gamma(x))，gamma = (1 + a) / (1 - a)，
+    任意分位数的估计值与真实值的相对误差不超过 a。
+
+    Args:
+        values: 数值列
+        groups: 分组列（可选）
+        relative_accuracy: 相对误差 a
+
+    Returns:
+        pa.Table: 列 group, bucket, count
+    """
+    gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+    table = pa.table({
+        'group': _group_column(groups, len(values)),
+        'value': pc.cast(values, pa.float64()),
+    }).filter(pc.is_valid(values))
+
+    x = table['value'].to_numpy()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        buckets = np.ceil(np.log(x) / math.log(gamma))
+    buckets = np.where(x > 0, buckets, NON_POSITIVE_BUCKET).astype(np.int32)
+
+    sketch = pa.table({
+        'group': table['group'],
+        'bucket': pa.array(buckets, pa.int32()),
+        'count': pa.array(np.ones(len(x), dtype=np.int64)),
+    })
+    return merge_quantile_sketches([sketch])
+
+
+def merge_quantile_sketches(sketches: list[pa.Table], by_group: bool = True) -> pa.Table:
+    """
+    合并多个分位数草图（同一桶的计数相加）
+
+    by_group 为 False 时忽略分组，得到所有分组合并后的草图。
+    """
+    table = pa.concat_tables(sketches)
+    if not by_group:
+        table = table.set_column(0, 'group', pa.nulls(len(table), pa.string()))
+    merged = table.group_by(['group', 'bucket']).aggregate([('count', 'sum')])
+    return merged.rename_columns({'count_sum': 'count'}).select(['group', 'bucket', 'count'])
+
+
+def quantile_column_name(q: float) -> str:
+    """分位数对应的列名，如 0.5 -> p50, 0.999 -> p99.9"""
+    return f"p{q * 100:g}"
+
+
+def quantile_estimate(
+    sketch: pa.Table,
+    quantiles: list[float],
+    relative_accuracy: float = QUANTILE_RELATIVE_ACCURACY,
+) -> pa.Table:
+    """
+    根据分位数草图估计每个分组的分位数
+
+    Returns:
+        pa.Table: 列 group, count, 以及每个分位数一列（如 p50, p90, p99）
+    """
+    gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+    if len(sketch) == 0:
+        return pa.table({
+            'group': pa.array([], pa.string()),
+            'count': pa.array([], pa.int64()),
+            **{quantile_column_name(q): pa.array([], pa.float64()) for q in quantiles},
+        })
+
+    sketch = sketch.sort_by([('group', 'ascending'), ('bucket', 'ascending')])
+    codes = pc.dictionary_encode(sketch['group']).combine_chunks().indices
+    codes = codes.fill_null(-1).to_numpy()
+    buckets = sketch['bucket'].to_numpy()
+    counts = sketch['count'].to_numpy()
+
+    # 排序后同一分组的桶连续：切出每个分组的区间，在全局累计计数上二分查找分位数所在的桶
+    group_starts = np.concatenate([[0], np.flatnonzero(np.diff(codes)) + 1]).astype(np.int64)
+    cumulative = np.cumsum(counts)
+    before = np.where(group_starts > 0, cumulative[group_starts - 1], 0)
+    group_counts = np.add.reduceat(counts, group_starts)
+
+    # 桶 k 的代表值 2 * gamma^k / (gamma + 1)
+    representative = np.where(
+        buckets == NON_POSITIVE_BUCKET, 0.0, 2 * np.power(gamma, buckets.astype(np.float64)) / (gamma + 1)
+    )
+
+    result = {
+        'group': sketch['group'].take(pa.array(group_starts)),
+        'count': pa.array(group_counts, pa.int64()),
+    }
+    for q in quantiles:
+        rank = before + np.floor(q * (group_counts - 1))
+        positions = np.searchsorted(cumulative, rank, side='right')
+        result[quantile_column_name(q)] = pa.array(representative[positions], pa.float64())
+
+    return pa.table(result)
@@ -0,0 +1,318 @@
+"""
+广告数据分片的数据质量校验
+
+所有检查都用 pyarrow compute 向量化执行，各分片在线程池中并行校验
+（Arrow 计算内核释放 GIL）：
+1. 行级检查：漏斗不变量、指标非负、主键非空、日期属于分片月份、(date, ad_id) 不重复
+2. 跨分片检查：层级关系唯一（ad → ad_set → campaign → advertiser）、ad 生命周期连续
+3. 元数据检查：metadata.json 的月份和行数与分片文件一致
+
+每个分片先算出部分聚合结果，跨分片检查只合并这些小表，不需要把所有分片拼在一起。
+日期属于分片月份且分片内 (date, ad_id) 不重复，即保证分片之间没有重叠。
+
+命令行用法（有违规时退出码为 1，可用于数据写入后的校验）：
+    python -m arrow_service.validation [--data-dir DIR] [--months 2025-01,2025-02] [--samples 5] [--json]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.ipc as ipc
+import pyarrow.parquet as pq
+
+# 漏斗不变量：(较小的指标, 较大的指标)
+FUNNEL_PAIRS = [
+    ('reach', 'impressions'),
+    ('clicks', 'impressions'),
+    ('inline_link_clicks', 'clicks'),
+    ('outbound_clicks', 'clicks'),
+    ('landing_page_view', 'outbound_clicks'),
+    ('onsite_web_add_to_cart', 'landing_page_view'),
+    ('onsite_web_checkout', 'onsite_web_add_to_cart'),
+    ('conversions', 'onsite_web_checkout'),
+]
+
+NON_NEGATIVE_COLUMNS = [
+    'cost', 'impressions', 'reach', 'clicks', 'inline_link_clicks', 'outbound_clicks',
+    'landing_page_view', 'onsite_web_checkout', 'onsite_web_add_to_cart', 'conversions',
+    'onsite_web_checkout_value', 'onsite_web_add_to_cart_value', 'gmv',
+]
+
+KEY_COLUMNS = ['date', 'advertiser_id', 'campaign_id', 'campaign_type', 'ad_set_id', 'ad_id']
+
+# 层级关系：每个子对象只能属于一个父对象
+HIERARCHY_PAIRS = [
+    ('ad_id', 'ad_set_id'),
+    ('ad_set_id', 'campaign_id'),
+    ('campaign_id', 'advertiser_id'),
+    ('campaign_id', 'campaign_type'),
+]
+
+DEFAULT_SAMPLE_SIZE = 5
+
+
+def json_value(value):
+    """将样本值转换为可JSON序列化的形式"""
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return value
+
+
+def sample_rows(table: pa.Table, sample_size: int) -> list[dict]:
+    """取前 sample_size 行作为违规样本"""
+    rows = table.slice(0, sample_size).to_pylist()
+    return [{key: json_value(value) for key, value in row.items()} for row in rows]
+
+
+def read_shard(shards_dir: Path, year_month: str) -> pa.Table:
+    """读取分片（IPC 分片已归档时读取 Parquet 分片）"""
+    shard_path = shards_dir / f"ads_{year_month}.arrow"
+    if shard_path.exists():
+        with pa.memory_map(str(shard_path), 'r') as source:
+            return ipc.open_file(source).read_all()
+    return pq.read_table(shards_dir / f"ads_{year_month}.parquet")
+
+
+def check_rows(table: pa.Table, date_ads: pa.Table, year_month: str, sample_size: int) -> dict:
+    """
+    分片内的行级检查
+
+    Args:
+        table: 分片数据
+        date_ads: 按 (date, ad_id) 分组的行数（列 date, ad_id, count_all）
+
+    Returns:
+        dict: 检查名 -> (违规行数, 违规样本)
+    """
+    masks = {}
+    for smaller, larger in FUNNEL_PAIRS:
+        masks[f"funnel:{smaller}<={larger}"] = pc.greater(table[smaller], table[larger])
+
+    for column in NON_NEGATIVE_COLUMNS:
+        masks[f"non_negative:{column}"] = pc.less(table[column], 0)
+
+    null_mask = pc.is_null(table[KEY_COLUMNS[0]])
+    for column in KEY_COLUMNS[1:]:
+        null_mask = pc.or_(null_mask, pc.is_null(table[column]))
+    masks["keys_not_null"] = null_mask
+
+    # 日期必须落在分片所属月份内，分片之间才不会重叠
+    month_start = date.fromisoformat(f"{year_month}-01")
+    next_month = date(month_start.year + month_start.month // 12, month_start.month % 12 + 1, 1)
+    masks["shard_month"] = pc.or_(
+        pc.less(table['date'], pa.scalar(month_start)),
+        pc.greater_equal(table['date'], pa.scalar(next_month)),
+    )
+
+    results = {}
+    for name, mask in masks.items():
+        mask = pc.fill_null(mask, False)
+        violations = pc.sum(mask).as_py() or 0
+        samples = sample_rows(table.filter(mask), sample_size) if violations else []
+        results[name] = (violations, samples)
+
+    # (date, ad_id) 在分片内唯一
+    duplicates = date_ads.filter(pc.greater(date_ads['count_all'], 1))
+    results["unique_date_ad"] = (
+        pc.sum(pc.subtract(duplicates['count_all'], 1)).as_py() or 0,
+        sample_rows(duplicates.rename_columns({'count_all': 'rows'}), sample_size),
+    )
+    return results
+
+
+def summarize_shard(shards_dir: Path, year_month: str, sample_size: int) -> dict:
+    """校验单个分片，并计算跨分片检查需要的部分聚合"""
+    table = read_shard(shards_dir, year_month)
+
+    # 全量数据上只做两次 group_by，其余聚合都在这两个小表上计算
+    date_ads = table.group_by(['date', 'ad_id']).aggregate([([], 'count_all')])
+    hierarchy = table.group_by(['ad_id', 'ad_set_id', 'campaign_id', 'advertiser_id', 'campaign_type']).aggregate([])
+
+    return {
+        "month": year_month,
+        "num_rows": len(table),
+        "row_checks": check_rows(table, date_ads, year_month, sample_size),
+        "hierarchy": {
+            (child, parent): hierarchy.group_by([child, parent]).aggregate([])
+            for child, parent in HIERARCHY_PAIRS
+        },
+        # 每个 (date, ad_id) 组合只出现一次，行数即不同日期数
+        "ad_days": date_ads.group_by('ad_id').aggregate([
+            ('date', 'min'), ('date', 'max'), ([], 'count_all'),
+        ]),
+    }
+
+
+def check_hierarchy(summaries: list[dict], sample_size: int) -> list[dict]:
+    """合并各分片的 (子, 父) 组合，检查每个子对象只有一个父对象"""
+    checks = []
+    for child, parent in HIERARCHY_PAIRS:
+        pairs = pa.concat_tables([s["hierarchy"][(child, parent)] for s in summaries])
+        parents = pairs.group_by(child).aggregate([(parent, 'count_distinct'), (parent, 'distinct')])
+        conflicts = parents.filter(pc.greater(parents[f"{parent}_count_distinct"], 1))
+        checks.append({
+            "name": f"hierarchy:{child}->{parent}",
+            "violations": len(conflicts),
+            "samples": sample_rows(
+                conflicts.select([child, f"{parent}_distinct"]).rename_columns([child, f"{parent}s"]),
+                sample_size,
+            ),
+        })
+    return checks
+
+
+def check_lifecycle(summaries: list[dict], sample_size: int) -> dict:
+    """
+    检查每个 ad 的投放日期连续（生命周期内每天都有数据）
+
+    结合层级关系唯一，ad 的生命周期即嵌套在所属 ad_set、campaign 的生命周期内。
+    """
+    days = pa.concat_tables([s["ad_days"] for s in summaries])
+    days = days.group_by('ad_id').aggregate([
+        ('date_min', 'min'), ('date_max', 'max'), ('count_all', 'sum'),
+    ])
+    span = pc.add(pc.days_between(days['date_min_min'], days['date_max_max']), 1)
+    gaps = pc.subtract(span, days['count_all_sum'])
+    mask = pc.not_equal(gaps, 0)
+    violations = days.filter(mask)
+    return {
+        "name": "lifecycle:ad_contiguous",
+        "violations": len(violations),
+        "samples": sample_rows(
+            pa.table({
+                'ad_id': violations['ad_id'],
+                'start': violations['date_min_min'],
+                'end': violations['date_max_max'],
+                'days': violations['count_all_sum'],
+            }),
+            sample_size,
+        ),
+    }
+
+
+def check_metadata(shards_dir: Path, summaries: list[dict], metadata: dict | None, sample_size: int) -> dict:
+    """检查 metadata.json 中的月份和行数与分片文件一致"""
+    problems = []
+    if metadata is None:
+        problems.append({"problem": "metadata.json not found"})
+    else:
+        listed = set(metadata.get('months', []))
+        on_disk = {p.stem.removeprefix('ads_') for p in shards_dir.glob('ads_*.arrow')}
+        on_disk |= {p.stem.removeprefix('ads_') for p in shards_dir.glob('ads_*.parquet')}
+        for month in sorted(on_disk - listed):
+            problems.append({"month": month, "problem": "shard file not listed in metadata"})
+        for month in sorted(listed - on_disk):
+            problems.append({"month": month, "problem": "listed in metadata but shard file missing"})
+
+        shards = metadata.get('shards', {})
+        for summary in summaries:
+            expected = shards.get(summary["month"], {}).get('num_rows')
+            if expected is not None and expected != summary["num_rows"]:
+                problems.append({
+                    "month": summary["month"],
+                    "problem": f"metadata num_rows {expected} != actual {summary['num_rows']}",
+                })
+
+    return {"name": "metadata", "violations": len(problems), "samples": problems[:sample_size]}
+
+
+def validate_shards(shards_dir: Path, months: list[str] | None = None, sample_size: int = DEFAULT_SAMPLE_SIZE,
+                    max_workers: int | None = None) -> dict:
+    """
+    校验广告数据分片
+
+    Args:
+        shards_dir: 分片目录
+        months: 要校验的月份，默认为 metadata.json 中的全部月份
+        sample_size: 每项检查返回的违规样本数
+        max_workers: 并行校验的线程数，默认为 CPU 核数
+
+    Returns:
+        dict: passed、分片数、行数、耗时，以及每项检查的违规数和样本
+    """
+    started = time.perf_counter()
+    shards_dir = Path(shards_dir)
+
+    metadata_path = shards_dir / "metadata.json"
+    metadata = None
+    if metadata_path.exists():
+        with open(metadata_path) as f:
+            metadata = json.load(f)
+
+    months = months or (metadata['months'] if metadata else [])
+    missing = [
+        m for m in months
+        if not (shards_dir / f"ads_{m}.arrow").exists() and not (shards_dir / f"ads_{m}.parquet").exists()
+    ]
+    if missing:
+        raise FileNotFoundError(f"Shard not found: {', '.join(missing)}")
+    if not months:
+        raise ValueError("No shards to validate")
+
+    with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+        summaries = list(executor.map(lambda m: summarize_shard(shards_dir, m, sample_size), months))
+
+    # 行级检查：按检查项汇总各分片的违规数，样本带上分片月份
+    checks = []
+    for name in summaries[0]["row_checks"]:
+        violations = 0
+        samples = []
+        for summary in summaries:
+            count, shard_samples = summary["row_checks"][name]
+            violations += count
+            samples.extend({"month": summary["month"], **row} for row in shard_samples)
+        checks.append({"name": name, "violations": violations, "samples": samples[:sample_size]})
+
+    checks.extend(check_hierarchy(summaries, sample_size))
+    checks.append(check_lifecycle(summaries, sample_size))
+    checks.append(check_metadata(shards_dir, summaries, metadata, sample_size))
+
+    return {
+        "passed": all(check["violations"] == 0 for check in checks),
+        "shards": len(summaries),
+        "rows": sum(summary["num_rows"] for summary in summaries),
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+        "checks": checks,
+    }
+
+
+def main():
+    """命令行入口：打印校验结果，有违规时退出码为 1"""
+    # 与 main.DATA_DIR 的默认值一致（容器中为 /app/data），不导入 main 以免加载整个服务
+    default_data_dir = os.environ.get("ARROW_DATA_DIR", str(Path(__file__).parent.parent / "data"))
+
+    parser = argparse.ArgumentParser(description="校验广告数据分片的数据质量")
+    parser.add_argument('--data-dir', default=default_data_dir, help="数据目录（包含 ads_shards/）")
+    parser.add_argument('--months', default=None, help="要校验的月份（逗号分隔），默认全部")
+    parser.add_argument('--samples', type=int, default=DEFAULT_SAMPLE_SIZE, help="每项检查输出的违规样本数")
+    parser.add_argument('--workers', type=int, default=None, help="并行线程数，默认为 CPU 核数")
+    parser.add_argument('--json', action='store_true', help="以 JSON 输出完整结果")
+    args = parser.parse_args()
+
+    months = [m.strip() for m in args.months.split(',') if m.strip()] if args.months else None
+    result = validate_shards(Path(args.data_dir) / "ads_shards", months, args.samples, args.workers)
+
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    else:
+        print(f"校验 {result['shards']} 个分片, {result['rows']:,} 行, 耗时 {result['elapsed_ms']:.0f} ms")
+        for check in result["checks"]:
+            status = "✓" if check["violations"] == 0 else "✗"
+            print(f"  {status} {check['name']}: {check['violations']}")
+            for sample in check["samples"]:
+                print(f"      {json.dumps(sample, ensure_ascii=False)}")
+        print("通过" if result["passed"] else "存在违规")
+
+    sys.exit(0 if result["passed"] else 1)
+
+
+if __name__ == '__main__':
+    main()
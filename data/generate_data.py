@@ -13,6 +13,35 @@ import random
 from datetime import datetime, timedelta
 import json
 
+# 广告日报表 schema（全量文件与月度分片共用）
+AD_REPORT_SCHEMA = pa.schema([
+    ('date', pa.date32()),
+    ('advertiser_id', pa.string()),
+    ('campaign_id', pa.string()),
+    ('campaign_type', pa.string()),
+    ('ad_set_id', pa.string()),
+    ('ad_id', pa.string()),
+    ('cost', pa.float32()),
+    ('impressions', pa.int32()),
+    ('reach', pa.int32()),
+    ('clicks', pa.int32()),
+    ('inline_link_clicks', pa.int32()),
+    ('outbound_clicks', pa.int32()),
+    ('landing_page_view', pa.int32()),
+    ('onsite_web_checkout', pa.int32()),
+    ('onsite_web_add_to_cart', pa.int32()),
+    ('conversions', pa.int32()),
+    ('onsite_web_checkout_value', pa.float32()),
+    ('onsite_web_add_to_cart_value', pa.float32()),
+    ('gmv', pa.float32()),
+])
+
+# Parquet 分片：按日期排序后每个 row group 只覆盖几天，min/max 统计可用于按日期裁剪 row group
+PARQUET_SORT_KEYS = ['date', 'advertiser_id', 'campaign_id', 'ad_set_id', 'ad_id']
+PARQUET_ROW_GROUP_SIZE = 16384
+PARQUET_DICTIONARY_COLUMNS = ['advertiser_id', 'campaign_id', 'campaign_type', 'ad_set_id', 'ad_id']
+
+
 def generate_base_metrics():
     """
     生成广告层级的基础指标
@@ -181,28 +210,8 @@ def generate_ad_report(num_campaigns=100, num_ad_sets_per_campaign=5, num_ads_pe
 
     print(f"  - 实际生成: {len(ads_data):,}条记录（考虑生命周期后）")
 
-    # 定义 Arrow schema，明确指定字段类型
-    schema = pa.schema([
-        ('date', pa.date32()),
-        ('advertiser_id', pa.string()),
-        ('campaign_id', pa.string()),
-        ('campaign_type', pa.string()),
-        ('ad_set_id', pa.string()),
-        ('ad_id', pa.string()),
-        ('cost', pa.float32()),
-        ('impressions', pa.int32()),
-        ('reach', pa.int32()),
-        ('clicks', pa.int32()),
-        ('inline_link_clicks', pa.int32()),
-        ('outbound_clicks', pa.int32()),
-        ('landing_page_view', pa.int32()),
-        ('onsite_web_checkout', pa.int32()),
-        ('onsite_web_add_to_cart', pa.int32()),
-        ('conversions', pa.int32()),
-        ('onsite_web_checkout_value', pa.float32()),
-        ('onsite_web_add_to_cart_value', pa.float32()),
-        ('gmv', pa.float32()),
-    ])
+    # 使用统一的 Arrow schema，明确指定字段类型
+    schema = AD_REPORT_SCHEMA
 
     # 转换为Arrow表格，使用指定的 schema
     ads_table = pa.Table.from_pylist(ads_data, schema=schema)
@@ -232,27 +241,7 @@ def save_ads_by_month(ads_data, output_dir):
         monthly_data[year_month].append(row)
 
     # 定义 Arrow schema
-    schema = pa.schema([
-        ('date', pa.date32()),
-        ('advertiser_id', pa.string()),
-        ('campaign_id', pa.string()),
-        ('campaign_type', pa.string()),
-        ('ad_set_id', pa.string()),
-        ('ad_id', pa.string()),
-        ('cost', pa.float32()),
-        ('impressions', pa.int32()),
-        ('reach', pa.int32()),
-        ('clicks', pa.int32()),
-        ('inline_link_clicks', pa.int32()),
-        ('outbound_clicks', pa.int32()),
-        ('landing_page_view', pa.int32()),
-        ('onsite_web_checkout', pa.int32()),
-        ('onsite_web_add_to_cart', pa.int32()),
-        ('conversions', pa.int32()),
-        ('onsite_web_checkout_value', pa.float32()),
-        ('onsite_web_add_to_cart_value', pa.float32()),
-        ('gmv', pa.float32()),
-    ])
+    schema = AD_REPORT_SCHEMA
 
     # 创建分片目录
     shards_dir = os.path.join(output_dir, 'ads_shards')
@@ -262,6 +251,7 @@ def save_ads_by_month(ads_data, output_dir):
 
     # 保存每个月的数据
     total_size = 0
+    shards = {}
     for year_month in sorted(monthly_data.keys()):
         month_data = monthly_data[year_month]
         month_table = pa.Table.from_pylist(month_data, schema=schema)
@@ -273,6 +263,12 @@ def save_ads_by_month(ads_data, output_dir):
 
         file_size = os.path.getsize(file_path)
         total_size += file_size
+        # 分片版本号 = 文件内 record batch 数量，追加数据时单调递增
+        shards[year_month] = {
+            'version': len(month_table.to_batches()),
+            'num_rows': len(month_data),
+            'size_bytes': file_size,
+        }
         print(f"  - {year_month}: {len(month_data):,} 条记录, {file_size / 1024 / 1024:.2f} MB")
 
     print(f"  - 总大小: {total_size / 1024 / 1024:.2f} MB")
@@ -283,6 +279,7 @@ def save_ads_by_month(ads_data, output_dir):
         'total_records': len(ads_data),
         'total_size_mb': total_size / 1024 / 1024,
         'schema': str(schema),
+        'shards': shards,
     }
 
     import json
@@ -295,6 +292,141 @@ def save_ads_by_month(ads_data, output_dir):
     return sorted(monthly_data.keys())
 
 
+def append_ads_to_shard(shards_dir, year_month, rows):
+    """
+    向指定月份的分片追加一批广告数据（模拟当月数据持续写入）
+
+    新数据作为一个新的 record batch 写在已有 batch 之后，分片版本号加一。
+    已加载该月份的客户端可以通过 /api/ad-report/shards/delta 只拉取新增的 batch。
+
+    Args:
+        shards_dir: 分片目录
+        year_month: 月份，如 '2025-11'
+        rows: 要追加的广告数据列表（字段与 AD_REPORT_SCHEMA 一致）
+
+    Returns:
+        int: 追加后的分片版本号
+    """
+    import os
+
+    file_path = os.path.join(shards_dir, f'ads_{year_month}.arrow')
+    tmp_path = file_path + '.tmp'
+    new_batch = pa.RecordBatch.from_pylist(rows, schema=AD_REPORT_SCHEMA)
+
+    # IPC 文件格式的 footer 在末尾，无法原地追加：复制已有 batch 后写入临时文件再原子替换
+    with pa.OSFile(tmp_path, 'wb') as sink:
+        with pa.ipc.new_file(sink, AD_REPORT_SCHEMA) as writer:
+            if os.path.exists(file_path):
+                with pa.memory_map(file_path, 'r') as source:
+                    reader = pa.ipc.open_file(source)
+                    for i in range(reader.num_record_batches):
+                        writer.write_batch(reader.get_batch(i))
+            writer.write_batch(new_batch)
+    os.replace(tmp_path, file_path)
+
+    with pa.memory_map(file_path, 'r') as source:
+        reader = pa.ipc.open_file(source)
+        version = reader.num_record_batches
+        num_rows = sum(reader.get_batch(i).num_rows for i in range(version))
+
+    # 更新分片元数据
+    metadata_path = os.path.join(shards_dir, 'metadata.json')
+    with open(metadata_path) as f:
+        metadata = json.load(f)
+
+    shards = metadata.setdefault('shards', {})
+    previous_rows = shards.get(year_month, {}).get('num_rows', 0)
+    shards[year_month] = {
+        'version': version,
+        'num_rows': num_rows,
+        'size_bytes': os.path.getsize(file_path),
+    }
+    metadata['months'] = sorted(set(metadata['months']) | {year_month})
+    metadata['total_records'] += num_rows - previous_rows
+    metadata['total_size_mb'] = sum(s['size_bytes'] for s in shards.values()) / 1024 / 1024
+
+    tmp_metadata_path = metadata_path + '.tmp'
+    with open(tmp_metadata_path, 'w') as f:
+        json.dump(metadata, f, indent=2)
+    os.replace(tmp_metadata_path, metadata_path)
+
+    return version
+
+
+def save_ads_shards_parquet(shards_dir, year_months=None, archive_months=None,
+                            row_group_size=PARQUET_ROW_GROUP_SIZE):
+    """
+    将月度 IPC 分片转存为 Parquet
+
+    数据按 PARQUET_SORT_KEYS 排序后写入，row group 带 min/max 统计，
+    字符串 ID 列使用字典编码，整体使用 zstd 压缩。
+
+    Args:
+        shards_dir: 分片目录
+        year_months: 要转存的月份，默认全部
+        archive_months: 转存后删除 IPC 文件、只保留 Parquet 的冷数据月份
+        row_group_size: 每个 row group 的行数
+
+    Returns:
+        dict: 每个月份的 Parquet 文件信息
+    """
+    import os
+
+    metadata_path = os.path.join(shards_dir, 'metadata.json')
+    with open(metadata_path) as f:
+        metadata = json.load(f)
+
+    year_months = year_months or metadata['months']
+    archive_months = set(archive_months or [])
+
+    print(f"\n转存 Parquet 分片到: {shards_dir}")
+
+    parquet_shards = {}
+    for year_month in year_months:
+        ipc_path = os.path.join(shards_dir, f'ads_{year_month}.arrow')
+        file_path = os.path.join(shards_dir, f'ads_{year_month}.parquet')
+        with pa.memory_map(ipc_path, 'r') as source:
+            table = pa.ipc.open_file(source).read_all()
+        table = table.sort_by([(key, 'ascending') for key in PARQUET_SORT_KEYS])
+
+        pq.write_table(
+            table,
+            file_path,
+            row_group_size=row_group_size,
+            compression='zstd',
+            use_dictionary=PARQUET_DICTIONARY_COLUMNS,
+            write_statistics=True,
+            sorting_columns=[
+                pq.SortingColumn(table.schema.get_field_index(key)) for key in PARQUET_SORT_KEYS
+            ],
+        )
+
+        file_size = os.path.getsize(file_path)
+        parquet_shards[year_month] = {
+            'num_rows': len(table),
+            'num_row_groups': pq.ParquetFile(file_path).num_row_groups,
+            'size_bytes': file_size,
+        }
+        shard = metadata.setdefault('shards', {}).setdefault(year_month, {})
+        shard['parquet'] = parquet_shards[year_month]
+
+        if year_month in archive_months:
+            os.remove(ipc_path)
+            shard['archived'] = True
+
+        ipc_size = shard.get('size_bytes', 0)
+        ratio = f", IPC 的 {file_size / ipc_size:.0%}" if ipc_size else ""
+        print(f"  - {year_month}: {file_size / 1024 / 1024:.2f} MB{ratio}"
+              f"{'（已归档，IPC 已删除）' if year_month in archive_months else ''}")
+
+    tmp_metadata_path = metadata_path + '.tmp'
+    with open(tmp_metadata_path, 'w') as f:
+        json.dump(metadata, f, indent=2)
+    os.replace(tmp_metadata_path, metadata_path)
+
+    return parquet_shards
+
+
 def generate_user_sku_logs(num_users=10000, num_skus=5000, num_events=1000000,
                           num_campaigns=100, num_ad_sets_per_campaign=5, num_ads_per_ad_set=3):
     """
@@ -395,9 +527,91 @@ def generate_user_sku_logs(num_users=10000, num_skus=5000, num_events=1000000,
     return table
 
 
+def save_user_sku_logs_by_hour(logs_table, output_dir):
+    """
+    将用户-SKU互动日志按天、小时分区保存
+
+    目录结构为 user_sku_logs/dt=YYYY-MM-DD/hour=HH.arrow，
+    metadata.json 记录每个分区的记录数、最小/最大时间戳和各事件类型数量，
+    后端据此只打开与查询时间窗口重叠的分区。
+
+    Args:
+        logs_table: 按 ts 排序的日志 Arrow 表
+        output_dir: 输出目录
+
+    Returns:
+        list: 分区元数据列表
+    """
+    import os
+    import pyarrow.compute as pc
+
+    partitions_dir = os.path.join(output_dir, 'user_sku_logs')
+    os.makedirs(partitions_dir, exist_ok=True)
+
+    print(f"\n按小时分区保存日志到: {partitions_dir}")
+
+    # 日志已按时间排序，用二分查找切出每个小时的连续区间（零拷贝 slice）
+    hours = pc.unique(pc.floor_temporal(logs_table['ts'], unit='hour'))
+    ts_values = logs_table['ts'].cast(pa.int64()).to_numpy()
+    hour_values = hours.cast(pa.int64()).to_numpy()
+    starts = np.searchsorted(ts_values, hour_values, side='left')
+    ends = np.append(starts[1:], len(ts_values))
+
+    partitions = []
+    total_size = 0
+    for hour_start, start, end in zip(hours.to_pylist(), starts, ends):
+        part_table = logs_table.slice(int(start), int(end - start))
+        dt = hour_start.strftime('%Y-%m-%d')
+        relative_path = f"dt={dt}/hour={hour_start.hour:02d}.arrow"
+        file_path = os.path.join(partitions_dir, relative_path)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
+        with pa.OSFile(file_path, 'wb') as sink:
+            with pa.ipc.new_file(sink, part_table.schema) as writer:
+                writer.write_table(part_table)
+
+        event_counts = pc.value_counts(part_table['event_type']).to_pylist()
+        file_size = os.path.getsize(file_path)
+        total_size += file_size
+        partitions.append({
+            'path': relative_path,
+            'dt': dt,
+            'hour': hour_start.hour,
+            'num_rows': len(part_table),
+            'size_bytes': file_size,
+            'min_ts': pc.min(part_table['ts']).as_py().isoformat(),
+            'max_ts': pc.max(part_table['ts']).as_py().isoformat(),
+            'event_counts': {item['values']: item['counts'] for item in event_counts},
+        })
+
+    print(f"  - 分区数: {len(partitions)}, 总大小: {total_size / 1024 / 1024:.2f} MB")
+
+    metadata = {
+        'total_records': len(logs_table),
+        'total_size_mb': total_size / 1024 / 1024,
+        'schema': str(logs_table.schema),
+        'partitions': partitions,
+    }
+    metadata_path = os.path.join(partitions_dir, 'metadata.json')
+    with open(metadata_path, 'w') as f:
+        json.dump(metadata, f, indent=2)
+
+    print(f"  - 元数据已保存: {metadata_path}")
+
+    return partitions
+
+
 def main():
     """主函数"""
     import os
+    import argparse
+
+    parser = argparse.ArgumentParser(description="生成Apache Arrow性能测试数据")
+    parser.add_argument('--parquet', action='store_true',
+                        help="额外将月度分片转存为 Parquet（排序的 row group、min/max 统计、字典编码）")
+    parser.add_argument('--archive-cold-months', type=int, default=None, metavar='N',
+                        help="配合 --parquet：只保留最近 N 个月的 IPC 分片，更早的月份只保留 Parquet")
+    args = parser.parse_args()
 
     # 创建输出目录
     output_dir = os.path.dirname(os.path.abspath(__file__))
@@ -430,6 +644,10 @@ def main():
     months = save_ads_by_month(ads_data, output_dir)
     print(f"\n分片保存完成，共 {len(months)} 个月份")
 
+    if args.parquet:
+        cold_months = months[:-args.archive_cold_months] if args.archive_cold_months else []
+        save_ads_shards_parquet(os.path.join(output_dir, 'ads_shards'), months, archive_months=cold_months)
+
     print("\n前端可以通过聚合 campaign_id 或 ad_set_id 来计算上层指标")
 
     # 生成用户-SKU互动日志
@@ -452,6 +670,9 @@ def main():
     file_size = os.path.getsize(user_sku_logs_path) / 1024 / 1024
     print(f"文件大小: {file_size:.2f} MB")
 
+    # 按天/小时分区保存，后端按时间窗口只读取重叠的分区
+    save_user_sku_logs_by_hour(user_sku_logs, output_dir)
+
     print("\n" + "=" * 60)
     print("数据生成完成!")
     print("=" * 60)
@@ -462,6 +683,8 @@ def main():
     print(f"  - 可通过 metadata.json 查看分片信息")
     print(f"  - 前端默认只加载最后一个月份的数据")
     print(f"  - 支持按需加载更多月份")
+    print(f"\n日志分区位置: {os.path.join(output_dir, 'user_sku_logs')}")
+    print(f"  - 按 dt=YYYY-MM-DD/hour=HH.arrow 分区，查询时只读取时间窗口内的分区")
 
 
 if __name__ == '__main__':
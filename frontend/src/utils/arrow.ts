@@ -21,6 +21,74 @@ export async function fetchArrowData(url: string): Promise<Table> {
   return table
 }
 
+/**
+ * 批量查询：一次请求获取多个Arrow表
+ *
+ * 后端返回 multipart/form-data，每个子查询一个 part，按子查询名称返回对应的表
+ */
+export async function fetchArrowBatch(url: string, body: unknown): Promise<Record<string, Table>> {
+  const response = await fetch(url, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify(body),
+  })
+
+  if (!response.ok) {
+    throw new Error(`Failed to fetch Arrow batch: ${response.statusText}`)
+  }
+
+  const formData = await response.formData()
+  const tables: Record<string, Table> = {}
+  for (const [name, part] of formData.entries()) {
+    tables[name] = tableFromIPC(new Uint8Array(await (part as Blob).arrayBuffer()))
+  }
+
+  return tables
+}
+
+/**
+ * 订阅分片实时推送：当前月份分片追加的 record batch 通过 WebSocket 推送
+ *
+ * 二进制帧拼接起来是一个 Arrow IPC Stream，第一帧为 schema，之后每帧一个 record batch；
+ * 文本帧为版本号控制消息。返回取消订阅的函数。
+ */
+export function subscribeArrowLive(
+  url: string,
+  onTable: (table: Table) => void,
+  onVersion?: (month: string, version: number) => void,
+): () => void {
+  const wsUrl = new URL(url, window.location.href)
+  wsUrl.protocol = wsUrl.protocol === 'https:' ? 'wss:' : 'ws:'
+
+  const socket = new WebSocket(wsUrl)
+  socket.binaryType = 'arraybuffer'
+
+  let schemaMessage: Uint8Array | null = null
+  socket.onmessage = (event) => {
+    if (typeof event.data === 'string') {
+      const message = JSON.parse(event.data)
+      if (message.type === 'version') {
+        onVersion?.(message.month, message.version)
+      }
+      return
+    }
+
+    const chunk = new Uint8Array(event.data)
+    if (!schemaMessage) {
+      schemaMessage = chunk
+      return
+    }
+
+    // schema 帧 + batch 帧即为可单独解码的 IPC Stream
+    const stream = new Uint8Array(schemaMessage.length + chunk.length)
+    stream.set(schemaMessage)
+    stream.set(chunk, schemaMessage.length)
+    onTable(tableFromIPC(stream))
+  }
+
+  return () => socket.close()
+}
+
 /**
  * 将Arrow Table转换为普通JS对象数组
  * 自动将 BigInt 转换为 Number 以避免类型混合错误
@@ -10,6 +10,7 @@ export default defineConfig({
       '/api': {
         target: process.env.VITE_API_BASE || 'http://localhost:8000',
         changeOrigin: true,
+        ws: true,
       },
     },
   },
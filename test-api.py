@@ -5,18 +5,40 @@ Apache Arrow 性能测试 API 测试脚本
 用法:
     python test-api.py                                    # 使用默认配置
     python test-api.py --base-url https://arrow-dev.mydomain.com  # 自定义URL
+    python test-api.py --load --spawn-server --workers 4 --concurrency 32 --duration 60  # 负载测试
 """
 
 import argparse
 import asyncio
 import httpx
+import json
+import math
+import os
+import random
+import ssl
+import subprocess
 import sys
+import time
 from datetime import date, datetime, timedelta
+from pathlib import Path
 
 
 # 默认配置
 DEFAULT_BASE_URL = "https://arrow-dev.127.0.0.1.sslip.io"
 
+# 负载测试的请求类型：名称 -> (路径, 参数)，参数中的 {month} 替换为最新的分片月份
+LOAD_SCENARIOS = {
+    "shards": ("/api/ad-report/shards", {"months": "{month}"}),
+    "delta": ("/api/ad-report/shards/delta", {"month": "{month}", "since": 0}),
+    "table": ("/api/ad-report/table", {"level": "campaign", "limit": 50}),
+    "distinct": ("/api/ad-report/distinct", {"column": "ad_id", "group_by": "campaign_type"}),
+    "logs": ("/api/user-sku-logs", {"limit": 10000}),
+    "histogram": ("/api/user-sku-logs/histogram", {}),
+    "funnel": ("/api/user-sku-logs/funnel", {"group_by": "sku_id", "top_n": 20}),
+    "stats": ("/api/stats", {}),
+}
+DEFAULT_LOAD_MIX = "shards=4,table=2,logs=2,histogram=1,funnel=1"
+
 
 async def test_health_check(client: httpx.AsyncClient, base_url: str):
     """测试健康检查端点"""
@@ -161,14 +183,707 @@ async def test_user_sku_logs(client: httpx.AsyncClient, base_url: str):
         print(f"状态码: {response.status_code}")
         print(f"筛选条件: 最近24小时")
         print(f"X-Row-Count: {response.headers.get('x-row-count')}")
+        print(f"X-Partitions-Scanned: {response.headers.get('x-partitions-scanned')}")
         assert response.status_code == 200
+        # 按小时分区存储时只读取与时间窗口重叠的分区
+        scanned, total = map(int, response.headers['x-partitions-scanned'].split('/'))
+        assert scanned < total
         print("✓ 时间筛选成功")
 
+        # 测试4: 时间窗口完全在日志范围之外，不读取任何分区
+        print("\n测试 4.4: 日志范围之外的时间窗口")
+        response = await client.get(
+            f"{base_url}/api/user-sku-logs",
+            params={"start_time": "1999-01-01T00:00:00", "end_time": "1999-01-02T00:00:00"}
+        )
+        print(f"状态码: {response.status_code}")
+        print(f"X-Row-Count: {response.headers.get('x-row-count')}")
+        print(f"X-Partitions-Scanned: {response.headers.get('x-partitions-scanned')}")
+        assert response.status_code == 200
+        assert int(response.headers['x-row-count']) == 0
+        scanned, total = map(int, response.headers['x-partitions-scanned'].split('/'))
+        assert scanned == 0 and total > 0
+        print("✓ 空时间窗口处理正确")
+
     except Exception as e:
         print(f"✗ 用户-SKU日志测试失败: {e}")
         raise
 
 
+async def test_user_sku_logs_rollups(client: httpx.AsyncClient, base_url: str):
+    """测试用户-SKU日志服务端聚合端点"""
+    print("\n" + "=" * 60)
+    print("5. 测试用户-SKU日志聚合 API")
+    print("=" * 60)
+
+    try:
+        # 测试1: 按小时统计事件分布
+        print("\n测试 5.1: 按小时统计事件分布")
+        response = await client.get(f"{base_url}/api/user-sku-logs/histogram")
+        print(f"状态码: {response.status_code}")
+        print(f"X-Row-Count: {response.headers.get('x-row-count')}")
+        print(f"X-Event-Count: {response.headers.get('x-event-count')}")
+        assert response.status_code == 200
+        assert response.headers.get('content-type') == 'application/vnd.apache.arrow.stream'
+        print("✓ 事件分布统计成功")
+
+        # 测试2: 整体漏斗和 Top SKU 漏斗
+        print("\n测试 5.2: 转化漏斗")
+        response = await client.get(f"{base_url}/api/user-sku-logs/funnel")
+        print(f"  整体漏斗: {response.headers.get('x-row-count')} 行")
+        assert response.status_code == 200
+        response = await client.get(
+            f"{base_url}/api/user-sku-logs/funnel",
+            params={"group_by": "sku_id", "top_n": 10}
+        )
+        print(f"  Top SKU: {response.headers.get('x-row-count')} / {response.headers.get('x-total-groups')} 组")
+        assert response.status_code == 200
+        assert int(response.headers.get('x-row-count')) <= 10
+        print("✓ 转化漏斗计算成功")
+
+        # 测试3: 不支持的时间粒度、分组维度和排序指标返回 400
+        print("\n测试 5.3: 非法参数返回 400")
+        for path, params in (
+            ("/api/user-sku-logs/histogram", {"interval": "minute"}),
+            ("/api/user-sku-logs/funnel", {"group_by": "user_id"}),
+            ("/api/user-sku-logs/funnel", {"sort_by": "foo"}),
+        ):
+            response = await client.get(f"{base_url}{path}", params=params)
+            print(f"  {path} {params}: {response.status_code}")
+            assert response.status_code == 400
+        print("✓ 参数校验正确")
+
+    except Exception as e:
+        print(f"✗ 用户-SKU日志聚合测试失败: {e}")
+        raise
+
+
+async def get_latest_shard_month(client: httpx.AsyncClient, base_url: str) -> str:
+    """从分片元数据获取最新月份"""
+    response = await client.get(f"{base_url}/api/ad-report/shards/metadata")
+    assert response.status_code == 200
+    return response.json()['months'][-1]
+
+
+async def test_ad_report_shards_delta(client: httpx.AsyncClient, base_url: str):
+    """测试分片增量同步端点"""
+    print("\n" + "=" * 60)
+    print("6. 测试分片增量同步 API")
+    print("=" * 60)
+
+    try:
+        month = await get_latest_shard_month(client, base_url)
+
+        # 测试1: 加载分片并记录版本号
+        print(f"\n测试 6.1: 加载分片 {month} 并记录版本号")
+        response = await client.get(f"{base_url}/api/ad-report/shards", params={"months": month})
+        print(f"状态码: {response.status_code}")
+        print(f"X-Shard-Versions: {response.headers.get('x-shard-versions')}")
+        assert response.status_code == 200
+        versions = dict(item.split(":") for item in response.headers['x-shard-versions'].split(","))
+        version = int(versions[month])
+        print("✓ 版本号获取成功")
+
+        # 测试2: 从当前版本增量同步，没有新增数据
+        print("\n测试 6.2: 从当前版本增量同步")
+        response = await client.get(
+            f"{base_url}/api/ad-report/shards/delta",
+            params={"month": month, "since": version}
+        )
+        print(f"状态码: {response.status_code}")
+        print(f"X-Shard-Version: {response.headers.get('x-shard-version')}")
+        print(f"X-Row-Count: {response.headers.get('x-row-count')}")
+        assert response.status_code == 200
+        assert int(response.headers['x-shard-version']) >= version
+        print("✓ 增量同步成功")
+
+        # 测试3: 客户端版本领先于分片（分片被重新生成）时返回 409
+        print("\n测试 6.3: 版本号超前返回 409")
+        response = await client.get(
+            f"{base_url}/api/ad-report/shards/delta",
+            params={"month": month, "since": version + 1000}
+        )
+        print(f"状态码: {response.status_code}")
+        assert response.status_code == 409
+        print("✓ 版本冲突检测成功")
+
+        # 测试4: 不存在的月份返回 404
+        print("\n测试 6.4: 不存在的月份返回 404")
+        response = await client.get(
+            f"{base_url}/api/ad-report/shards/delta",
+            params={"month": "1999-01"}
+        )
+        print(f"状态码: {response.status_code}")
+        assert response.status_code == 404
+        print("✓ 不存在的月份处理正确")
+
+    except Exception as e:
+        print(f"✗ 分片增量同步测试失败: {e}")
+        raise
+
+
+async def test_attribution(client: httpx.AsyncClient, base_url: str):
+    """测试广告花费 × 用户购买归因端点"""
+    print("\n" + "=" * 60)
+    print("7. 测试归因 API")
+    print("=" * 60)
+
+    try:
+        # 测试1: 按计划归因（默认日期范围为日志的时间范围）
+        print("\n测试 7.1: 按计划归因")
+        response = await client.get(f"{base_url}/api/attribution")
+        print(f"状态码: {response.status_code}")
+        print(f"X-Row-Count: {response.headers.get('x-row-count')}")
+        print(f"X-Date-Range: {response.headers.get('x-date-range')}")
+        assert response.status_code == 200
+        assert response.headers.get('content-type') == 'application/vnd.apache.arrow.stream'
+        print("✓ 按计划归因成功")
+
+        # 测试2: 按广告组按天拆分
+        print("\n测试 7.2: 按广告组按天归因")
+        response = await client.get(
+            f"{base_url}/api/attribution",
+            params={"grain": "ad_set", "daily": "true"}
+        )
+        print(f"状态码: {response.status_code}")
+        print(f"X-Row-Count: {response.headers.get('x-row-count')}")
+        assert response.status_code == 200
+        print("✓ 按天归因成功")
+
+        # 测试3: 不支持的粒度返回 400
+        print("\n测试 7.3: 不支持的粒度返回 400")
+        response = await client.get(f"{base_url}/api/attribution", params={"grain": "advertiser"})
+        print(f"状态码: {response.status_code}")
+        assert response.status_code == 400
+        print("✓ 参数校验正确")
+
+        # 测试4: 没有分片覆盖的日期范围返回 404
+        print("\n测试 7.4: 没有分片覆盖的日期范围返回 404")
+        response = await client.get(
+            f"{base_url}/api/attribution",
+            params={"start_date": "1999-01-01", "end_date": "1999-01-31"}
+        )
+        print(f"状态码: {response.status_code}")
+        assert response.status_code == 404
+        print("✓ 日期范围校验正确")
+
+    except Exception as e:
+        print(f"✗ 归因测试失败: {e}")
+        raise
+
+
+async def test_sketches(client: httpx.AsyncClient, base_url: str):
+    """测试近似 distinct count 和分位数端点"""
+    print("\n" + "=" * 60)
+    print("8. 测试近似统计 API")
+    print("=" * 60)
+
+    try:
+        # 测试1: 按计划类型统计 ad 去重数
+        print("\n测试 8.1: ad_id 近似去重计数")
+        response = await client.get(
+            f"{base_url}/api/ad-report/distinct",
+            params={"column": "ad_id", "group_by": "campaign_type"}
+        )
+        print(f"状态码: {response.status_code}")
+        print(f"X-Row-Count: {response.headers.get('x-row-count')}")
+        print(f"X-Loaded-Months: {response.headers.get('x-loaded-months')}")
+        assert response.status_code == 200
+        assert response.headers.get('content-type') == 'application/vnd.apache.arrow.stream'
+        print("✓ 近似去重计数成功")
+
+        # 测试2: 花费分位数
+        print("\n测试 8.2: cost 近似分位数")
+        response = await client.get(
+            f"{base_url}/api/ad-report/quantiles",
+            params={"column": "cost", "q": "0.5,0.99"}
+        )
+        print(f"状态码: {response.status_code}")
+        assert response.status_code == 200
+        print("✓ 近似分位数成功")
+
+        # 测试3: 用户日志去重计数
+        print("\n测试 8.3: 用户日志 user_id 近似去重计数")
+        response = await client.get(
+            f"{base_url}/api/user-sku-logs/distinct",
+            params={"column": "user_id", "group_by": "event_type"}
+        )
+        print(f"状态码: {response.status_code}")
+        print(f"X-Row-Count: {response.headers.get('x-row-count')}")
+        assert response.status_code == 200
+        print("✓ 用户日志去重计数成功")
+
+        # 测试4: 不支持的列和非法分位数返回 400
+        print("\n测试 8.4: 非法参数返回 400")
+        response = await client.get(f"{base_url}/api/ad-report/distinct", params={"column": "date"})
+        print(f"  column=date: {response.status_code}")
+        assert response.status_code == 400
+        response = await client.get(f"{base_url}/api/ad-report/quantiles", params={"q": "1.5"})
+        print(f"  q=1.5: {response.status_code}")
+        assert response.status_code == 400
+        print("✓ 参数校验正确")
+
+    except Exception as e:
+        print(f"✗ 近似统计测试失败: {e}")
+        raise
+
+
+async def test_ad_report_table(client: httpx.AsyncClient, base_url: str):
+    """测试广告明细表服务端排序和分页端点"""
+    print("\n" + "=" * 60)
+    print("9. 测试广告明细表分页 API")
+    print("=" * 60)
+
+    try:
+        # 测试1: 按花费降序取第一页和第二页
+        print("\n测试 9.1: 按花费排序分页")
+        params = {"level": "campaign", "sort_by": "cost", "order": "desc", "limit": 10}
+        first = await client.get(f"{base_url}/api/ad-report/table", params={**params, "offset": 0})
+        second = await client.get(f"{base_url}/api/ad-report/table", params={**params, "offset": 10})
+        print(f"状态码: {first.status_code}, {second.status_code}")
+        print(f"X-Total-Count: {first.headers.get('x-total-count')}")
+        print(f"X-Row-Count: {first.headers.get('x-row-count')}, {second.headers.get('x-row-count')}")
+        assert first.status_code == 200 and second.status_code == 200
+        total_count = int(first.headers['x-total-count'])
+        assert int(second.headers['x-total-count']) == total_count
+        assert int(first.headers['x-row-count']) == min(10, total_count)
+        assert int(second.headers['x-row-count']) == min(10, max(total_count - 10, 0))
+        print("✓ 分页成功")
+
+        # 测试2: 偏移超过总行数时返回空页
+        print("\n测试 9.2: 偏移超过总行数")
+        response = await client.get(
+            f"{base_url}/api/ad-report/table",
+            params={**params, "offset": total_count}
+        )
+        print(f"状态码: {response.status_code}")
+        print(f"X-Row-Count: {response.headers.get('x-row-count')}")
+        assert response.status_code == 200
+        assert int(response.headers['x-row-count']) == 0
+        print("✓ 空页处理正确")
+
+        # 测试3: 不支持的排序指标返回 400，超出范围的 limit 返回 422
+        print("\n测试 9.3: 非法参数")
+        response = await client.get(f"{base_url}/api/ad-report/table", params={"sort_by": "name"})
+        print(f"  sort_by=name: {response.status_code}")
+        assert response.status_code == 400
+        response = await client.get(f"{base_url}/api/ad-report/table", params={"limit": 0})
+        print(f"  limit=0: {response.status_code}")
+        assert response.status_code == 422
+        print("✓ 参数校验正确")
+
+    except Exception as e:
+        print(f"✗ 广告明细表分页测试失败: {e}")
+        raise
+
+
+async def test_ad_report_batch(client: httpx.AsyncClient, base_url: str):
+    """测试批量查询端点"""
+    print("\n" + "=" * 60)
+    print("10. 测试批量查询 API")
+    print("=" * 60)
+
+    try:
+        # 测试1: 一次请求返回聚合结果和明细，每个子查询一个 multipart part
+        print("\n测试 10.1: 聚合 + 明细两个子查询")
+        response = await client.post(
+            f"{base_url}/api/ad-report/batch",
+            json={
+                "queries": [
+                    {
+                        "name": "by_type",
+                        "group_by": ["campaign_type"],
+                        "aggregates": [{"column": "cost", "op": "sum"}],
+                        "sort_by": [["cost_sum", "descending"]],
+                    },
+                    {"name": "top_ads", "columns": ["ad_id", "cost"], "sort_by": [["cost", "descending"]], "limit": 5},
+                ]
+            }
+        )
+        print(f"状态码: {response.status_code}")
+        print(f"Content-Type: {response.headers.get('content-type')}")
+        print(f"X-Base-Row-Count: {response.headers.get('x-base-row-count')}")
+        assert response.status_code == 200
+        content_type = response.headers['content-type']
+        assert content_type.startswith('multipart/form-data')
+        boundary = content_type.split('boundary=')[1]
+        parts = response.content.split(f"--{boundary}".encode())[1:-1]
+        names = [part.split(b'name="')[1].split(b'"')[0].decode() for part in parts]
+        print(f"Parts: {names}")
+        assert names == ['by_type', 'top_ads']
+        assert all(b'application/vnd.apache.arrow.stream' in part for part in parts)
+        print("✓ 批量查询成功")
+
+        # 测试2: 子查询名称重复或引用不存在的列返回 400
+        print("\n测试 10.2: 非法子查询返回 400")
+        response = await client.post(
+            f"{base_url}/api/ad-report/batch",
+            json={"queries": [{"name": "a", "columns": ["ad_id"]}, {"name": "a", "columns": ["cost"]}]}
+        )
+        print(f"  名称重复: {response.status_code}")
+        assert response.status_code == 400
+        response = await client.post(
+            f"{base_url}/api/ad-report/batch",
+            json={"queries": [{"name": "a", "group_by": ["no_such_column"]}]}
+        )
+        print(f"  未知列: {response.status_code}")
+        assert response.status_code == 400
+        print("✓ 参数校验正确")
+
+    except Exception as e:
+        print(f"✗ 批量查询测试失败: {e}")
+        raise
+
+
+async def test_sampling(client: httpx.AsyncClient, base_url: str):
+    """测试确定性行采样"""
+    print("\n" + "=" * 60)
+    print("11. 测试确定性采样")
+    print("=" * 60)
+
+    try:
+        month = await get_latest_shard_month(client, base_url)
+
+        # 测试1: 相同 seed 的两次采样返回相同的数据
+        print(f"\n测试 11.1: 分片 {month} 按行数采样，相同 seed")
+        params = {"months": month, "sample": "100", "seed": 42}
+        first = await client.get(f"{base_url}/api/ad-report/shards", params=params)
+        second = await client.get(f"{base_url}/api/ad-report/shards", params=params)
+        print(f"状态码: {first.status_code}, {second.status_code}")
+        print(f"X-Row-Count: {first.headers.get('x-row-count')} / X-Unsampled-Row-Count: {first.headers.get('x-unsampled-row-count')}")
+        assert first.status_code == 200 and second.status_code == 200
+        assert int(first.headers['x-row-count']) == min(100, int(first.headers['x-unsampled-row-count']))
+        assert first.content == second.content
+        print("✓ 相同 seed 采样结果一致")
+
+        # 测试2: 按计划类型分层、按比例采样
+        print("\n测试 11.2: 按计划类型分层采样")
+        response = await client.get(
+            f"{base_url}/api/ad-report/shards",
+            params={"months": month, "sample": "0.1", "seed": 7, "stratify": "campaign_type"}
+        )
+        print(f"状态码: {response.status_code}")
+        print(f"X-Row-Count: {response.headers.get('x-row-count')}")
+        assert response.status_code == 200
+        print("✓ 分层采样成功")
+
+        # 测试3: 非法采样参数和不存在的分层列返回 400，负数 seed 返回 422
+        print("\n测试 11.3: 非法采样参数")
+        for invalid in ({"sample": "abc"}, {"sample": "1.5"}, {"sample": "0.1", "stratify": "no_such_column"}):
+            response = await client.get(f"{base_url}/api/ad-report/shards", params={"months": month, **invalid})
+            print(f"  {invalid}: {response.status_code}")
+            assert response.status_code == 400
+        for path, params in (
+            ("/api/ad-report/shards", {"months": month}),
+            ("/api/ad-report", {}),
+            ("/api/user-sku-logs", {}),
+        ):
+            response = await client.get(f"{base_url}{path}", params={**params, "sample": "10", "seed": -1})
+            print(f"  {path} seed=-1: {response.status_code}")
+            assert response.status_code == 422
+        print("✓ 参数校验正确")
+
+    except Exception as e:
+        print(f"✗ 确定性采样测试失败: {e}")
+        raise
+
+
+async def test_ready(client: httpx.AsyncClient, base_url: str):
+    """测试启动预热就绪检查端点"""
+    print("\n" + "=" * 60)
+    print("12. 测试就绪检查")
+    print("=" * 60)
+
+    try:
+        # 测试1: 预热进行中返回 503，结束后（即使有步骤失败）返回 200
+        print("\n测试 12.1: 等待预热结束")
+        deadline = time.monotonic() + 60
+        while True:
+            response = await client.get(f"{base_url}/ready")
+            state = response.json()
+            if response.status_code == 200:
+                break
+            print(f"  状态码: {response.status_code}，预热进行中")
+            assert response.status_code == 503
+            assert state['finished_at'] is None, "预热已结束但 /ready 仍返回 503"
+            assert time.monotonic() < deadline, "预热在 60 秒内未结束"
+            await asyncio.sleep(0.5)
+        print(f"状态码: {response.status_code}")
+        print(f"预热步骤: {len(state['steps'])} 个，失败: {len(state['errors'])} 个")
+        assert state['ready'] is True
+        if state['started_at'] is not None:
+            assert state['finished_at'] is not None
+        print("✓ 服务已就绪")
+
+        # 测试2: 失败的步骤记录在 errors 中，与 steps 中的 error 字段一致
+        print("\n测试 12.2: 预热错误记录")
+        for error in state['errors']:
+            print(f"  ✗ {error['step']}: {error['error']}")
+        failed_steps = [s['name'] for s in state['steps'] if 'error' in s]
+        assert failed_steps == [e['step'] for e in state['errors'] if e['step'] is not None]
+        print("✓ 预热错误记录一致")
+
+    except Exception as e:
+        print(f"✗ 就绪检查测试失败: {e}")
+        raise
+
+
+async def test_stats_detail(client: httpx.AsyncClient, base_url: str):
+    """测试统计信息的列级详情"""
+    print("\n" + "=" * 60)
+    print("13. 测试统计信息详情")
+    print("=" * 60)
+
+    try:
+        # 测试1: detail=true 返回每列 min/max 和近似 distinct count，基础统计与不带 detail 时一致
+        print("\n测试 13.1: 列级统计")
+        summary = (await client.get(f"{base_url}/api/stats")).json()
+        response = await client.get(f"{base_url}/api/stats", params={"detail": "true"})
+        print(f"状态码: {response.status_code}")
+        assert response.status_code == 200
+        data = response.json()
+        for name, dataset in data.items():
+            assert dataset['total_rows'] == summary[name]['total_rows']
+            for column in dataset['columns'].values():
+                assert {'null_count', 'min', 'max', 'distinct_estimate'} <= column.keys()
+        ad_id = data['ads_shards']['columns']['ad_id']
+        print(f"  ads_shards.ad_id: ~{ad_id['distinct_estimate']} 个不同值, min={ad_id['min']}, max={ad_id['max']}")
+        print("✓ 列级统计获取成功")
+
+        # 测试2: 非法的 detail 参数返回 422
+        print("\n测试 13.2: 非法参数返回 422")
+        response = await client.get(f"{base_url}/api/stats", params={"detail": "maybe"})
+        print(f"状态码: {response.status_code}")
+        assert response.status_code == 422
+        print("✓ 参数校验正确")
+
+    except Exception as e:
+        print(f"✗ 统计信息详情测试失败: {e}")
+        raise
+
+
+async def get_metrics(client: httpx.AsyncClient, base_url: str) -> dict[str, float]:
+    """读取 /metrics（Prometheus 文本格式），返回 指标名（含标签）-> 值"""
+    response = await client.get(f"{base_url}/metrics")
+    assert response.status_code == 200
+    metrics = {}
+    for line in response.text.splitlines():
+        if line and not line.startswith('#'):
+            name, _, value = line.rpartition(' ')
+            metrics[name] = float(value)
+    return metrics
+
+
+async def test_admission_control(client: httpx.AsyncClient, base_url: str):
+    """测试大响应准入控制"""
+    print("\n" + "=" * 60)
+    print("14. 测试大响应准入控制")
+    print("=" * 60)
+
+    try:
+        month = await get_latest_shard_month(client, base_url)
+        metrics = await get_metrics(client, base_url)
+        limit = int(metrics['arrow_export_max_response_bytes'])
+        print(f"ARROW_MAX_RESPONSE_BYTES: {limit}")
+
+        # 测试1: 放行的导出带预估大小，响应结束后释放在途预算
+        print(f"\n测试 14.1: 导出分片 {month}")
+        response = await client.get(f"{base_url}/api/ad-report/shards", params={"months": month})
+        print(f"状态码: {response.status_code}")
+        print(f"X-Estimated-Bytes: {response.headers.get('x-estimated-bytes')}")
+        if response.status_code == 200:
+            assert int(response.headers['x-estimated-bytes']) <= limit
+            metrics = await get_metrics(client, base_url)
+            print(f"在途字节数: {metrics['arrow_export_inflight_bytes']:.0f}")
+            # 测试依次发送请求，响应结束后在途预算应全部释放
+            assert metrics['arrow_export_inflight_bytes'] == 0
+            assert metrics['arrow_export_inflight_requests'] == 0
+            print("✓ 导出放行成功")
+        else:
+            assert response.status_code == 413
+            print("✓ 单月分片已超过上限，返回 413")
+
+        # 测试2: 预估超过 ARROW_MAX_RESPONSE_BYTES 时返回 413（放行时预估必须不超过上限）
+        print("\n测试 14.2: 导出所有月份")
+        rejected = metrics.get('arrow_export_rejected_total{reason="too_large"}', 0)
+        response = await client.get(f"{base_url}/api/ad-report/shards")
+        print(f"状态码: {response.status_code}")
+        if response.status_code == 413:
+            print(f"  {response.json()['detail']}")
+            metrics = await get_metrics(client, base_url)
+            assert metrics['arrow_export_rejected_total{reason="too_large"}'] == rejected + 1
+            print("✓ 超出上限的导出被拒绝")
+        else:
+            assert response.status_code == 200
+            assert int(response.headers['x-estimated-bytes']) <= limit
+            print(f"✓ 预估 {response.headers['x-estimated-bytes']} 字节未超过上限，已放行"
+                  "（启动后端时设置较小的 ARROW_MAX_RESPONSE_BYTES 可覆盖 413）")
+
+    except Exception as e:
+        print(f"✗ 大响应准入控制测试失败: {e}")
+        raise
+
+
+async def test_parquet_export(client: httpx.AsyncClient, base_url: str):
+    """测试 Parquet 导出"""
+    print("\n" + "=" * 60)
+    print("15. 测试 Parquet 导出")
+    print("=" * 60)
+
+    try:
+        month = await get_latest_shard_month(client, base_url)
+
+        # 测试1: 分片按列投影导出为 Parquet 文件
+        print(f"\n测试 15.1: 分片 {month} 导出 Parquet")
+        response = await client.get(
+            f"{base_url}/api/ad-report/shards",
+            params={"months": month, "columns": "date,ad_id,cost", "format": "parquet"}
+        )
+        print(f"状态码: {response.status_code}")
+        print(f"Content-Type: {response.headers.get('content-type')}")
+        print(f"Content-Disposition: {response.headers.get('content-disposition')}")
+        print(f"X-Row-Groups-Scanned: {response.headers.get('x-row-groups-scanned')}")
+        assert response.status_code == 200
+        assert response.headers.get('content-type') == 'application/vnd.apache.parquet'
+        # Parquet 文件以 PAR1 开头和结尾
+        assert response.content[:4] == b'PAR1' and response.content[-4:] == b'PAR1'
+        print("✓ 分片 Parquet 导出成功")
+
+        # 测试2: 用户日志导出 Parquet
+        print("\n测试 15.2: 用户日志导出 Parquet")
+        response = await client.get(f"{base_url}/api/user-sku-logs", params={"limit": 1000, "format": "parquet"})
+        print(f"状态码: {response.status_code}")
+        print(f"X-Row-Count: {response.headers.get('x-row-count')}")
+        assert response.status_code == 200
+        assert response.content[:4] == b'PAR1'
+        print("✓ 用户日志 Parquet 导出成功")
+
+        # 测试3: 不支持的格式和不存在的列返回 400
+        print("\n测试 15.3: 非法参数返回 400")
+        response = await client.get(f"{base_url}/api/ad-report/shards", params={"months": month, "format": "csv"})
+        print(f"  format=csv: {response.status_code}")
+        assert response.status_code == 400
+        response = await client.get(
+            f"{base_url}/api/ad-report/shards",
+            params={"months": month, "columns": "no_such_column", "format": "parquet"}
+        )
+        print(f"  columns=no_such_column: {response.status_code}")
+        assert response.status_code == 400
+        print("✓ 参数校验正确")
+
+    except Exception as e:
+        print(f"✗ Parquet 导出测试失败: {e}")
+        raise
+
+
+async def test_ad_report_shards_live(client: httpx.AsyncClient, base_url: str):
+    """测试分片实时推送（WebSocket，需要安装 websockets）"""
+    print("\n" + "=" * 60)
+    print("16. 测试分片实时推送")
+    print("=" * 60)
+
+    try:
+        import websockets
+    except ImportError:
+        print("未安装 websockets（pip install websockets），跳过")
+        return
+
+    ws_url = base_url.replace("https://", "wss://", 1).replace("http://", "ws://", 1)
+    ssl_context = None
+    if ws_url.startswith("wss://"):
+        # 与 httpx 客户端一致，不校验自签名证书
+        ssl_context = ssl.create_default_context()
+        ssl_context.check_hostname = False
+        ssl_context.verify_mode = ssl.CERT_NONE
+
+    async def receive_until_close(params: dict) -> int:
+        """连接后等待服务端关闭连接，返回关闭码"""
+        url = f"{ws_url}/api/ad-report/shards/live?{httpx.QueryParams(params)}"
+        async with websockets.connect(url, ssl=ssl_context) as websocket:
+            try:
+                while True:
+                    await asyncio.wait_for(websocket.recv(), timeout=10)
+            except websockets.ConnectionClosed as e:
+                return e.rcvd.code if e.rcvd else None
+
+    try:
+        month = await get_latest_shard_month(client, base_url)
+        response = await client.get(f"{base_url}/api/ad-report/shards/delta", params={"month": month, "since": 0})
+        assert response.status_code == 200
+        version = int(response.headers['x-shard-version'])
+
+        # 测试1: 从版本 0 订阅，收到 schema 帧、已有的 batch 帧和版本号消息
+        print(f"\n测试 16.1: 订阅分片 {month}（since=0，当前版本 {version}）")
+        url = f"{ws_url}/api/ad-report/shards/live?{httpx.QueryParams({'month': month, 'since': 0})}"
+        binary_frames = 0
+        latest_version = None
+        async with websockets.connect(url, ssl=ssl_context) as websocket:
+            while latest_version != version:
+                message = await asyncio.wait_for(websocket.recv(), timeout=10)
+                if isinstance(message, bytes):
+                    binary_frames += 1
+                else:
+                    control = json.loads(message)
+                    assert control['type'] == 'version' and control['month'] == month
+                    latest_version = control['version']
+        print(f"二进制帧: {binary_frames}（含 schema 帧），版本号: {latest_version}")
+        assert binary_frames >= 1
+        print("✓ 实时推送成功")
+
+        # 测试2: 不存在的月份以 4404 关闭，版本号超前以 4409 关闭
+        print("\n测试 16.2: 错误以关闭码返回")
+        code = await receive_until_close({"month": "1999-01"})
+        print(f"  month=1999-01: {code}")
+        assert code == 4404
+        code = await receive_until_close({"month": month, "since": version + 1000})
+        print(f"  since={version + 1000}: {code}")
+        assert code == 4409
+        print("✓ 关闭码正确")
+
+    except Exception as e:
+        print(f"✗ 分片实时推送测试失败: {e}")
+        raise
+
+
+async def test_validate(client: httpx.AsyncClient, base_url: str):
+    """测试数据质量校验端点"""
+    print("\n" + "=" * 60)
+    print("17. 测试数据质量校验")
+    print("=" * 60)
+
+    try:
+        month = await get_latest_shard_month(client, base_url)
+
+        # 测试1: 校验单个月份（生成数据可能存在违规，只检查结果结构）
+        print(f"\n测试 17.1: 校验分片 {month}")
+        response = await client.get(f"{base_url}/api/ad-report/validate", params={"months": month, "samples": 2})
+        print(f"状态码: {response.status_code}")
+        assert response.status_code == 200
+        result = response.json()
+        print(f"passed: {result['passed']}, {result['shards']} 个分片, {result['rows']} 行, {result['elapsed_ms']} ms")
+        for check in result['checks']:
+            if check['violations']:
+                print(f"  ✗ {check['name']}: {check['violations']}")
+        assert result['shards'] == 1
+        assert result['passed'] == all(check['violations'] == 0 for check in result['checks'])
+        assert all(len(check['samples']) <= 2 for check in result['checks'])
+        print("✓ 数据质量校验成功")
+
+        # 测试2: 不存在的月份返回 404，样本数超出范围返回 422
+        print("\n测试 17.2: 非法参数")
+        response = await client.get(f"{base_url}/api/ad-report/validate", params={"months": "1999-01"})
+        print(f"  months=1999-01: {response.status_code}")
+        assert response.status_code == 404
+        response = await client.get(f"{base_url}/api/ad-report/validate", params={"samples": 1000})
+        print(f"  samples=1000: {response.status_code}")
+        assert response.status_code == 422
+        print("✓ 参数校验正确")
+
+    except Exception as e:
+        print(f"✗ 数据质量校验测试失败: {e}")
+        raise
+
+
 async def run_tests(base_url: str):
     """运行所有测试"""
     print("=" * 60)
@@ -184,6 +899,19 @@ async def run_tests(base_url: str):
             await test_stats(client, base_url)
             await test_ad_report(client, base_url)
             await test_user_sku_logs(client, base_url)
+            await test_user_sku_logs_rollups(client, base_url)
+            await test_ad_report_shards_delta(client, base_url)
+            await test_attribution(client, base_url)
+            await test_sketches(client, base_url)
+            await test_ad_report_table(client, base_url)
+            await test_ad_report_batch(client, base_url)
+            await test_sampling(client, base_url)
+            await test_ready(client, base_url)
+            await test_stats_detail(client, base_url)
+            await test_admission_control(client, base_url)
+            await test_parquet_export(client, base_url)
+            await test_ad_report_shards_live(client, base_url)
+            await test_validate(client, base_url)
 
             print("\n" + "=" * 60)
             print("✓ 所有测试通过！")
@@ -197,6 +925,216 @@ async def run_tests(base_url: str):
             return 1
 
 
+def parse_load_mix(mix: str) -> dict[str, float]:
+    """解析请求比例，如 "shards=4,logs=2,stats=1" """
+    weights = {}
+    for item in mix.split(","):
+        name, _, weight = item.strip().partition("=")
+        if name not in LOAD_SCENARIOS:
+            raise ValueError(f"未知的请求类型 {name}，可选: {', '.join(LOAD_SCENARIOS)}")
+        weights[name] = float(weight or 1)
+    return weights
+
+
+def percentile(sorted_values: list[float], q: float) -> float:
+    """最近秩分位数，sorted_values 需已排序"""
+    if not sorted_values:
+        return 0.0
+    index = max(0, math.ceil(q * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+def process_tree_rss(pid: int) -> int:
+    """读取 /proc 中进程及其所有子进程（如 granian worker）的 RSS 之和（字节）"""
+    children = {}
+    for stat_path in Path("/proc").glob("[0-9]*/stat"):
+        try:
+            fields = stat_path.read_text().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        children.setdefault(int(fields[1]), []).append(int(stat_path.parent.name))
+
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        pending.extend(children.get(current, []))
+        try:
+            for line in Path(f"/proc/{current}/status").read_text().splitlines():
+                if line.startswith("VmRSS:"):
+                    total += int(line.split()[1]) * 1024
+        except OSError:
+            continue
+    return total
+
+
+def spawn_server(port: int, workers: int, data_dir: str | Path):
+    """在本地启动 granian（与 backend/Dockerfile 相同的参数），返回进程"""
+    env = dict(os.environ)
+    env["ARROW_DATA_DIR"] = str(Path(data_dir).resolve())
+    return subprocess.Popen(
+        [
+            sys.executable, "-m", "granian", "arrow_service.main:app",
+            "--interface", "asgi",
+            "--host", "127.0.0.1",
+            "--port", str(port),
+            "--workers", str(workers),
+            "--http", "1",
+            "--backlog", "2048",
+            "--loop", "uvloop",
+        ],
+        cwd=Path(__file__).parent / "backend",
+        env=env,
+    )
+
+
+async def wait_until_ready(base_url: str, server: subprocess.Popen | None, timeout: float = 120.0):
+    """轮询 /ready 直到启动预热完成"""
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(verify=False, timeout=5.0) as client:
+        while time.monotonic() < deadline:
+            if server is not None and server.poll() is not None:
+                raise RuntimeError(f"服务进程已退出，退出码 {server.returncode}")
+            try:
+                response = await client.get(f"{base_url}/ready")
+                if response.status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.5)
+    raise TimeoutError(f"服务在 {timeout:.0f} 秒内未就绪")
+
+
+async def run_load_test(base_url: str, concurrency: int, duration: float, mix: dict[str, float],
+                        server_pid: int | None = None, sample_interval: float = 1.0, seed: int = 0):
+    """
+    负载测试：concurrency 个并发客户端在 duration 秒内按 mix 比例持续发送请求
+
+    每个客户端使用独立的连接池，请求完成（包括读取完整响应体）后立即发送下一个请求。
+    报告吞吐、延迟分位数、错误率，以及每个采样间隔的吞吐和服务进程 RSS。
+    """
+    async with httpx.AsyncClient(verify=False, timeout=30.0) as client:
+        metadata = (await client.get(f"{base_url}/api/ad-report/shards/metadata")).json()
+    month = metadata["months"][-1]
+
+    requests = {}
+    for name in mix:
+        path, params = LOAD_SCENARIOS[name]
+        requests[name] = (
+            f"{base_url}{path}",
+            {key: value.format(month=month) if isinstance(value, str) else value for key, value in params.items()},
+        )
+    names = list(mix)
+    weights = [mix[name] for name in names]
+
+    # 每个请求记录 (完成时间, 请求类型, 延迟秒数, 状态码或异常名, 响应字节数)
+    results = []
+    timeline = []
+    started = time.monotonic()
+    deadline = started + duration
+
+    async def client_loop(client_id: int):
+        rng = random.Random(seed * 100003 + client_id)
+        async with httpx.AsyncClient(verify=False, timeout=60.0) as client:
+            while time.monotonic() < deadline:
+                name = rng.choices(names, weights)[0]
+                url, params = requests[name]
+                request_start = time.perf_counter()
+                try:
+                    response = await client.get(url, params=params)
+                    status, size = response.status_code, len(response.content)
+                except httpx.HTTPError as e:
+                    status, size = type(e).__name__, 0
+                results.append((time.monotonic() - started, name, time.perf_counter() - request_start, status, size))
+
+    async def sampler():
+        completed = 0
+        last_sample = started
+        while time.monotonic() < deadline:
+            await asyncio.sleep(sample_interval)
+            now = time.monotonic()
+            window = results[completed:]
+            completed += len(window)
+            timeline.append((
+                now - started,
+                len(window) / (now - last_sample),
+                sum(1 for r in window if not (isinstance(r[3], int) and r[3] < 400)),
+                process_tree_rss(server_pid) if server_pid else None,
+            ))
+            last_sample = now
+
+    print(f"\n负载测试: {concurrency} 个并发客户端, {duration:.0f} 秒, 请求比例 {mix}")
+    print(f"目标URL: {base_url}, 分片月份: {month}")
+    await asyncio.gather(sampler(), *(client_loop(i) for i in range(concurrency)))
+    elapsed = time.monotonic() - started
+
+    print_load_report(results, timeline, elapsed)
+    errors = sum(1 for r in results if not (isinstance(r[3], int) and r[3] < 400))
+    return 0 if results and errors == 0 else 1
+
+
+def print_load_report(results: list[tuple], timeline: list[tuple], elapsed: float):
+    """打印负载测试结果"""
+    print("\n" + "=" * 60)
+    print("负载测试结果")
+    print("=" * 60)
+
+    def summarize(label: str, rows: list[tuple]):
+        latencies = sorted(r[2] * 1000 for r in rows)
+        errors = sum(1 for r in rows if not (isinstance(r[3], int) and r[3] < 400))
+        print(
+            f"{label:<10} {len(rows):>8} {len(rows) / elapsed:>9.1f} "
+            f"{percentile(latencies, 0.5):>8.1f} {percentile(latencies, 0.9):>8.1f} "
+            f"{percentile(latencies, 0.99):>8.1f} {(latencies[-1] if latencies else 0):>8.1f} "
+            f"{(errors / len(rows) if rows else 0):>7.2%}"
+        )
+
+    print(f"{'请求类型':<8} {'请求数':>6} {'req/s':>9} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8} {'错误率':>5}")
+    for name in sorted({r[1] for r in results}):
+        summarize(name, [r for r in results if r[1] == name])
+    summarize("total", results)
+
+    total_bytes = sum(r[4] for r in results)
+    print(f"\n传输: {total_bytes / 1024 / 1024:.1f} MB, {total_bytes / 1024 / 1024 / elapsed:.1f} MB/s")
+
+    statuses = {}
+    for r in results:
+        statuses[r[3]] = statuses.get(r[3], 0) + 1
+    print(f"状态码: {dict(sorted(statuses.items(), key=lambda item: str(item[0])))}")
+
+    print(f"\n{'时间 s':>8} {'req/s':>9} {'错误':>6} {'服务 RSS MB':>12}")
+    for t, throughput, errors, rss in timeline:
+        rss_text = f"{rss / 1024 / 1024:.1f}" if rss is not None else "-"
+        print(f"{t:>8.1f} {throughput:>9.1f} {errors:>6} {rss_text:>12}")
+
+
+def run_load(args) -> int:
+    """负载测试入口：可选启动本地 granian，测试结束后关闭"""
+    mix = parse_load_mix(args.mix)
+    server = None
+    base_url = args.base_url
+    server_pid = args.server_pid
+    if args.spawn_server:
+        server = spawn_server(args.port, args.workers, args.data_dir)
+        base_url = f"http://127.0.0.1:{args.port}"
+        server_pid = server.pid
+        print(f"已启动 granian (pid {server.pid}, {args.workers} 个 worker)，等待预热完成...")
+
+    try:
+        asyncio.run(wait_until_ready(base_url, server))
+        return asyncio.run(run_load_test(
+            base_url, args.concurrency, args.duration, mix,
+            server_pid=server_pid, sample_interval=args.sample_interval, seed=args.seed,
+        ))
+    finally:
+        if server is not None:
+            server.terminate()
+            try:
+                server.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                server.kill()
+
+
 def main():
     parser = argparse.ArgumentParser(description="Apache Arrow 性能测试 API 测试脚本")
     parser.add_argument(
@@ -205,8 +1143,29 @@ def main():
         help=f"API 基础 URL (默认: {DEFAULT_BASE_URL})"
     )
 
+    load = parser.add_argument_group("负载测试")
+    load.add_argument("--load", action="store_true", help="运行负载测试而不是功能测试")
+    load.add_argument("--concurrency", type=int, default=16, help="并发客户端数 (默认: 16)")
+    load.add_argument("--duration", type=float, default=30, help="持续时间，秒 (默认: 30)")
+    load.add_argument(
+        "--mix",
+        default=DEFAULT_LOAD_MIX,
+        help=f"请求比例，可选 {', '.join(LOAD_SCENARIOS)} (默认: {DEFAULT_LOAD_MIX})"
+    )
+    load.add_argument("--seed", type=int, default=0, help="请求序列的随机种子 (默认: 0)")
+    load.add_argument("--sample-interval", type=float, default=1.0, help="吞吐和 RSS 的采样间隔，秒 (默认: 1)")
+    load.add_argument("--spawn-server", action="store_true", help="在本地启动 granian 并对其测试，忽略 --base-url")
+    load.add_argument("--port", type=int, default=8765, help="本地 granian 端口 (默认: 8765)")
+    load.add_argument("--workers", type=int, default=1, help="本地 granian worker 数 (默认: 1)")
+    load.add_argument("--data-dir", default=Path(__file__).parent / "data",
+                      help="本地 granian 使用的数据目录 (默认: 仓库根目录下的 data/)")
+    load.add_argument("--server-pid", type=int, default=None, help="未使用 --spawn-server 时，采样该本地进程的 RSS")
+
     args = parser.parse_args()
 
+    if args.load:
+        sys.exit(run_load(args))
+
     # 运行异步测试
     exit_code = asyncio.run(run_tests(args.base_url))
     sys.exit(exit_code)